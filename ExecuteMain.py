@@ -1,37 +1,593 @@
 import datetime
+import decimal
+import hashlib
+import importlib
+import itertools
+import math
 import json
+import numbers
+import os
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
 import urllib
+import uuid
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import streamlit as st
+from sqlalchemy import Column, MetaData, Table
+from sqlalchemy import bindparam
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import make_url
 from sqlalchemy import text
-import io
+from sqlalchemy import types as sa_types
 import xlsxwriter
 
 #pip freeze > requirements.txt
 #streamlit run app7.py
 
-def get_sqlalchemy_engine(conn_config):
+# Pool settings used when a connection does not override them in the "Snowflake Config" tab
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_RECYCLE = 3600
+DEFAULT_POOL_PRE_PING = True
+
+# Connection keys that affect how the engine is built; editing any of them invalidates the pooled engine
+ENGINE_CONFIG_KEYS = ('user', 'password', 'account', 'url', 'warehouse', 'database', 'schema', 'role',
+                      'pool_size', 'pool_recycle', 'pool_pre_ping')
+
+
+def connection_fingerprint(conn_config):
+    payload = json.dumps({key: conn_config.get(key) for key in ENGINE_CONFIG_KEYS}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+@st.cache_resource
+def _engine_registry():
+    # Lives for the whole server process so engines survive Streamlit reruns.
+    # 'engines' maps fingerprint -> engine, 'owners' maps (session id, connection id) -> fingerprint.
+    return {'engines': {}, 'owners': {}, 'lock': threading.Lock()}
+
+
+def _build_connection_string(conn_config):
+    # A full SQLAlchemy URL in the optional URL field (e.g. sqlite:///local.db) is used as-is,
+    # which lets the app run against a local stand-in instead of Snowflake
+    if '://' in (conn_config.get('url') or ''):
+        return conn_config['url']
     user = urllib.parse.quote_plus(conn_config['user'])
     password = urllib.parse.quote_plus(conn_config['password'])
-    connection_string = (
+    return (
         f"snowflake://{user}:{password}@{conn_config['account']}/"
         f"{conn_config['database']}/{conn_config['schema']}?"
         f"warehouse={conn_config['warehouse']}&role={conn_config.get('role', '')}"
     )
-    return create_engine(connection_string)
 
-def fetch_data(sql_query, conn_config, sample_size=None):
+
+def _sqlite_row_hash(*values):
+    digest = hashlib.blake2b(repr(values).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class _SqliteHashAgg:
+    # Order-independent checksum: sum of row hashes modulo 2**64
+    def __init__(self):
+        self.total = 0
+
+    def step(self, *values):
+        self.total = (self.total + _sqlite_row_hash(*values)) % 2 ** 64
+
+    def finalize(self):
+        return self.total - 2 ** 64 if self.total >= 2 ** 63 else self.total
+
+
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    dbapi_connection.create_function('row_hash', -1, _sqlite_row_hash, deterministic=True)
+    dbapi_connection.create_aggregate('hash_agg', -1, _SqliteHashAgg)
+
+
+def export_connection_config(conn_config):
+    # Connection settings safe to write to a file: no user or password, and a full URL's password masked
+    exported = {key: value for key, value in conn_config.items() if key not in ('user', 'password')}
+    if '://' in (exported.get('url') or ''):
+        try:
+            exported['url'] = make_url(exported['url']).render_as_string(hide_password=True)
+        except Exception:
+            # Not a parseable URL, so there is no telling where a password would be
+            exported['url'] = ''
+    return exported
+
+
+def _create_pooled_engine(conn_config):
+    connection_string = _build_connection_string(conn_config)
+    pool_options = {
+        'pool_pre_ping': bool(conn_config.get('pool_pre_ping', DEFAULT_POOL_PRE_PING)),
+        'pool_recycle': int(conn_config.get('pool_recycle') or DEFAULT_POOL_RECYCLE),
+    }
+    if connection_string.startswith('sqlite'):
+        engine = create_engine(connection_string, **pool_options)
+        # SQLite has no hash functions, checksum comparisons need them
+        event.listen(engine, 'connect', _register_sqlite_functions)
+        return engine
+    pool_options['pool_size'] = int(conn_config.get('pool_size') or DEFAULT_POOL_SIZE)
+    return create_engine(connection_string, **pool_options)
+
+
+def get_sqlalchemy_engine(conn_config):
+    fingerprint = connection_fingerprint(conn_config)
+    registry = _engine_registry()
+    with registry['lock']:
+        engine = registry['engines'].get(fingerprint)
+        if engine is None:
+            engine = _create_pooled_engine(conn_config)
+            registry['engines'][fingerprint] = engine
+    return engine
+
+
+def _dispose_unowned(registry, fingerprints):
+    for fingerprint in fingerprints:
+        if fingerprint and fingerprint not in registry['owners'].values():
+            engine = registry['engines'].pop(fingerprint, None)
+            if engine is not None:
+                engine.dispose()
+
+
+def claim_engine(owner, conn_config):
+    # Records which settings a session's connection uses. owner is (session id, connection id), connection
+    # ids like conn_1 repeat across sessions. When the connection was edited, the pool built for its old
+    # settings is disposed unless another owner still uses it.
+    registry = _engine_registry()
+    fingerprint = connection_fingerprint(conn_config)
+    with registry['lock']:
+        previous = registry['owners'].get(owner)
+        registry['owners'][owner] = fingerprint
+        if previous != fingerprint:
+            _dispose_unowned(registry, [previous])
+
+
+def invalidate_engine(owner, conn_config):
+    # The session dropped the connection: dispose its pool unless another owner still uses it
+    registry = _engine_registry()
+    with registry['lock']:
+        previous = registry['owners'].pop(owner, None)
+        _dispose_unowned(registry, {connection_fingerprint(conn_config), previous})
+
+
+def get_pool_stats():
+    registry = _engine_registry()
+    with registry['lock']:
+        owners = {fingerprint: owner[1] for owner, fingerprint in registry['owners'].items()}
+        engines = list(registry['engines'].items())
+    stats = []
+    for fingerprint, engine in engines:
+        pool = engine.pool
+        stats.append({
+            'connection_id': owners.get(fingerprint),
+            'fingerprint': fingerprint[:12],
+            'pool': type(pool).__name__,
+            'size': pool.size() if hasattr(pool, 'size') else None,
+            'checked_in': pool.checkedin() if hasattr(pool, 'checkedin') else None,
+            'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+            'overflow': pool.overflow() if hasattr(pool, 'overflow') else None,
+        })
+    return stats
+
+# 'pandas' goes through pd.read_sql, 'arrow' pulls record batches and keeps Arrow-backed dtypes
+FETCH_MODES = ('pandas', 'arrow')
+ARROW_FETCH_BATCH_ROWS = 100000
+# Default chunk size for streamed fetches
+STREAM_CHUNK_ROWS = 50000
+
+
+def _infer_array(column):
+    try:
+        return pa.array(column)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        # Mixed Python types (SQLite columns have no fixed type), keep them as strings
+        return pa.array([None if value is None else str(value) for value in column])
+
+
+def _rows_to_record_batch(rows, names, schema=None):
+    columns = list(zip(*rows)) if rows else [[] for _ in names]
+    if schema is None:
+        arrays = [_infer_array(column) for column in columns]
+        # Columns that are all NULL in the first batch have no type yet, keep them as strings
+        arrays = [array.cast(pa.string()) if pa.types.is_null(array.type) else array for array in arrays]
+        return pa.RecordBatch.from_arrays(arrays, names=names)
+    # Later batches keep the earlier types where the values fit. A column whose values do not fit (1.5 in an
+    # int64 column) is widened and the batch comes back with the wider schema instead of truncated values.
+    arrays = []
+    for column, field in zip(columns, schema):
+        array = _infer_array(column)
+        try:
+            # Safe cast, raises instead of losing data
+            arrays.append(array.cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            widened = pa.unify_schemas([pa.schema([field]), pa.schema([field.with_type(array.type)])],
+                                       promote_options='permissive').field(0).type
+            arrays.append(array.cast(widened))
+    return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def _iter_record_batches(sql_query, conn_config, batch_rows=ARROW_FETCH_BATCH_ROWS):
+    engine = get_sqlalchemy_engine(conn_config)
+    raw_connection = engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        cursor.execute(sql_query)
+        names = [column[0] for column in cursor.description]
+        if engine.dialect.requires_name_normalize:
+            # Same names SQLAlchemy results carry (Snowflake's ID becomes id), so Arrow frames match the rest
+            names = [engine.dialect.normalize_name(name) for name in names]
+        if hasattr(cursor, 'fetch_arrow_batches'):
+            # Snowflake cursor: result chunks arrive as Arrow already and are downloaded lazily
+            has_rows = False
+            for table in cursor.fetch_arrow_batches():
+                for batch in table.to_batches():
+                    has_rows = True
+                    yield batch.rename_columns(names)
+            if not has_rows:
+                yield _rows_to_record_batch([], names)
+            return
+        if hasattr(cursor, 'fetch_record_batch'):
+            # DuckDB cursor
+            for batch in cursor.fetch_record_batch(batch_rows):
+                yield batch.rename_columns(names)
+            return
+        # Plain DBAPI fallback (SQLite and other local stand-ins)
+        schema = None
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows and schema is not None:
+                break
+            batch = _rows_to_record_batch(rows, names, schema)
+            schema = batch.schema
+            yield batch
+            if not rows:
+                break
+    finally:
+        raw_connection.close()
+
+
+def _rebatch(batches, chunk_rows=None, chunk_bytes=None):
+    # Re-slices record batches into tables bounded by a row count and/or a byte budget
+    pending, pending_rows, pending_bytes = [], 0, 0
+    schema = None
+    yielded = False
+    for batch in batches:
+        if schema is not None and batch.schema != schema:
+            # A column was widened by a later batch (see _rows_to_record_batch). Batches not yielded yet are
+            # widened too; a chunk already handed out cannot be, so streaming has to stop there.
+            if yielded:
+                changed = ", ".join(f"{old.name} {old.type} -> {new.type}"
+                                    for old, new in zip(schema, batch.schema) if old.type != new.type)
+                raise ValueError(f"Column types changed mid-stream ({changed}); "
+                                 f"cast the columns in the query or use a single chunk")
+            schema = pa.unify_schemas([schema, batch.schema], promote_options='permissive')
+            pending = [piece.cast(schema) for piece in pending]
+            batch = batch.cast(schema)
+        schema = schema or batch.schema
+        while batch.num_rows:
+            room = batch.num_rows
+            if chunk_rows:
+                room = min(room, chunk_rows - pending_rows)
+            if chunk_bytes:
+                row_bytes = max(1, batch.nbytes // batch.num_rows)
+                room = min(room, max(1, (chunk_bytes - pending_bytes) // row_bytes))
+            piece = batch.slice(0, room)
+            batch = batch.slice(room)
+            pending.append(piece)
+            pending_rows += piece.num_rows
+            pending_bytes += piece.nbytes
+            if (chunk_rows and pending_rows >= chunk_rows) or (chunk_bytes and pending_bytes >= chunk_bytes):
+                yield pa.Table.from_batches(pending, schema=schema)
+                pending, pending_rows, pending_bytes = [], 0, 0
+                yielded = True
+    # An empty result still yields one (empty) chunk so consumers see the columns
+    if schema is not None and (pending or not yielded):
+        yield pa.Table.from_batches(pending, schema=schema)
+
+
+def stream_record_batches(sql_query, conn_config, chunk_rows=STREAM_CHUNK_ROWS, chunk_bytes=None):
+    batch_rows = min(chunk_rows or ARROW_FETCH_BATCH_ROWS, ARROW_FETCH_BATCH_ROWS)
+    yield from _rebatch(_iter_record_batches(sql_query, conn_config, batch_rows), chunk_rows, chunk_bytes)
+
+
+def stream_data(sql_query, conn_config, chunk_rows=STREAM_CHUNK_ROWS, chunk_bytes=None, fetch_mode='arrow'):
+    # Yields DataFrames of at most chunk_rows rows / roughly chunk_bytes bytes.
+    # With no budget at all the whole result comes back as a single chunk.
+    if fetch_mode == 'arrow':
+        for table in stream_record_batches(sql_query, conn_config, chunk_rows, chunk_bytes):
+            yield table.to_pandas(types_mapper=pd.ArrowDtype)
+        return
     engine = get_sqlalchemy_engine(conn_config)
     with engine.connect() as connection:
-        if sample_size:
-            # Use LIMIT SQL clause to fetch sample data
-            sql_query = f"{sql_query} LIMIT {sample_size}"
-        df = pd.read_sql(sql_query, connection)
-    return df
+        if not chunk_rows and not chunk_bytes:
+            yield pd.read_sql(sql_query, connection)
+            return
+        # Server-side cursor so the driver does not buffer the whole result
+        connection = connection.execution_options(stream_results=True)
+        chunks = pd.read_sql(sql_query, connection, chunksize=chunk_rows or STREAM_CHUNK_ROWS)
+        if not chunk_bytes:
+            yield from chunks
+            return
+        for chunk in chunks:
+            row_bytes = max(1, int(chunk.memory_usage(deep=True).sum()) // max(1, len(chunk)))
+            rows_per_piece = max(1, chunk_bytes // row_bytes)
+            for start in range(0, max(1, len(chunk)), rows_per_piece):
+                yield chunk.iloc[start:start + rows_per_piece]
+
+
+def fetch_arrow_table(sql_query, conn_config, sample_size=None):
+    if sample_size:
+        sql_query = f"{sql_query} LIMIT {sample_size}"
+    return pa.concat_tables(stream_record_batches(sql_query, conn_config, chunk_rows=None))
+
+
+def fetch_data(sql_query, conn_config, sample_size=None, fetch_mode='pandas'):
+    if sample_size:
+        # Use LIMIT SQL clause to fetch sample data
+        sql_query = f"{sql_query} LIMIT {sample_size}"
+    # A full fetch is a stream without a chunk budget
+    chunks = list(stream_data(sql_query, conn_config, chunk_rows=None, fetch_mode=fetch_mode))
+    if len(chunks) == 1:
+        return chunks[0]
+    return pd.concat(chunks, ignore_index=True)
+
+
+# Excel's hard row limit per worksheet, the header takes one of them
+EXCEL_MAX_ROWS = 1048576
+
+
+def _excel_value(value):
+    # Types xlsxwriter does not know (bytes, intervals, ...) are written as text
+    if value is None or isinstance(value, (str, numbers.Number, datetime.date, datetime.time, datetime.timedelta)):
+        return value
+    return str(value)
+
+
+def _excel_rows(chunk):
+    # NULLs become empty cells, everything else goes through as plain Python values
+    for row in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None):
+        yield [_excel_value(value) for value in row]
+
+
+def export_excel_stream(chunks, path=None):
+    # Writes a stream of DataFrames to an .xlsx file on disk in xlsxwriter's constant-memory mode,
+    # starting a new sheet whenever Excel's row limit is reached. Returns (path, rows_written).
+    # A temp file created here is removed again if writing fails.
+    created = path is None
+    if created:
+        handle, path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(handle)
+    try:
+        return _write_excel_stream(chunks, path)
+    except BaseException:
+        if created and os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+def _write_excel_stream(chunks, path):
+    workbook = xlsxwriter.Workbook(path, {
+        'constant_memory': True,
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+        'nan_inf_to_errors': True,
+        'remove_timezone': True,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+    })
+    worksheet = None
+    columns = None
+    sheet_row = 0
+    rows_written = 0
+    try:
+        for chunk in chunks:
+            if columns is None:
+                columns = [str(column) for column in chunk.columns]
+            for row in _excel_rows(chunk):
+                if worksheet is None or sheet_row >= EXCEL_MAX_ROWS:
+                    worksheet = workbook.add_worksheet(f"Sheet{len(workbook.worksheets()) + 1}")
+                    worksheet.write_row(0, 0, columns)
+                    sheet_row = 1
+                worksheet.write_row(sheet_row, 0, row)
+                sheet_row += 1
+                rows_written += 1
+        if worksheet is None:
+            worksheet = workbook.add_worksheet('Sheet1')
+            worksheet.write_row(0, 0, columns or [])
+    finally:
+        workbook.close()
+    return path, rows_written
+
+
+# Label -> (writer, codec, file extension, mime type) for the columnar export buttons
+COLUMNAR_EXPORT_FORMATS = {
+    'Parquet (zstd)': ('parquet', 'zstd', '.parquet', 'application/vnd.apache.parquet'),
+    'Parquet (snappy)': ('parquet', 'snappy', '.parquet', 'application/vnd.apache.parquet'),
+    'Feather': ('feather', 'zstd', '.feather', 'application/vnd.apache.arrow.file'),
+    'CSV (gzip)': ('csv', 'gzip', '.csv.gz', 'application/gzip'),
+    'CSV (zstd)': ('csv', 'zstd', '.csv.zst', 'application/zstd'),
+}
+
+
+def _open_columnar_writer(kind, codec, path, schema):
+    if kind == 'parquet':
+        return pq.ParquetWriter(path, schema, compression=codec), None
+    if kind == 'feather':
+        sink = pa.OSFile(path, 'wb')
+        return pa.ipc.new_file(sink, schema, options=pa.ipc.IpcWriteOptions(compression=codec)), sink
+    sink = pa.CompressedOutputStream(path, codec)
+    return pa_csv.CSVWriter(sink, schema), sink
+
+
+def export_columnar_stream(tables, export_format, path=None):
+    # Writes a stream of Arrow tables straight into a Parquet / Feather / compressed CSV file
+    # without ever building a DataFrame. Returns (path, rows_written).
+    # A temp file created here is removed again if writing fails.
+    kind, codec, extension, _ = COLUMNAR_EXPORT_FORMATS[export_format]
+    created = path is None
+    if created:
+        handle, path = tempfile.mkstemp(suffix=extension)
+        os.close(handle)
+    try:
+        return _write_columnar_stream(tables, kind, codec, path)
+    except BaseException:
+        if created and os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+def _write_columnar_stream(tables, kind, codec, path):
+    writer, sink = None, None
+    rows_written = 0
+    try:
+        for table in tables:
+            if writer is None:
+                schema = table.schema
+                writer, sink = _open_columnar_writer(kind, codec, path, schema)
+            elif table.schema != schema:
+                table = table.cast(schema)
+            writer.write_table(table)
+            rows_written += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+        if sink is not None:
+            sink.close()
+    return path, rows_written
+
+
+def benchmark_fetch_modes(sql_query, conn_config, repeats=3):
+    # Times every fetch mode on the same query and records peak Python and Arrow allocations
+    results = []
+    for fetch_mode in FETCH_MODES:
+        for run in range(repeats):
+            tracemalloc.start()
+            arrow_before = pa.total_allocated_bytes()
+            started = time.perf_counter()
+            df = fetch_data(sql_query, conn_config, fetch_mode=fetch_mode)
+            elapsed = time.perf_counter() - started
+            _, python_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results.append({
+                'fetch_mode': fetch_mode,
+                'run': run + 1,
+                'rows': len(df),
+                'seconds': round(elapsed, 4),
+                'python_peak_mb': round(python_peak / 2 ** 20, 2),
+                'arrow_mb': round((pa.total_allocated_bytes() - arrow_before) / 2 ** 20, 2),
+                'dataframe_mb': round(df.memory_usage(deep=True).sum() / 2 ** 20, 2),
+            })
+            del df
+    return pd.DataFrame(results)
 
-def run_query(query_config, connections, full_fetch=False, count_only=False):
+# Example usage
+# conn = {'id': 'local', 'url': 'sqlite:///local.db', 'user': '', 'password': ''}
+# print(benchmark_fetch_modes("SELECT * FROM big_table", conn).groupby('fetch_mode').median(numeric_only=True))
+
+# Cross-rerun result cache in front of run_query
+RESULT_CACHE_TTL_SECONDS = 900
+RESULT_CACHE_MAX_BYTES = 1024 * 2 ** 20
+
+
+@st.cache_resource
+def _result_cache():
+    return {'entries': OrderedDict(), 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0, 'lock': threading.Lock()}
+
+
+def normalize_sql(sql):
+    # Collapse whitespace and drop trailing semicolons, leaving quoted literals untouched
+    parts = re.split(r"('(?:[^']|'')*')", sql.strip().rstrip(';'))
+    return ''.join(part if part.startswith("'") else re.sub(r'\s+', ' ', part) for part in parts).strip()
+
+
+def _result_nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    return 64
+
+
+def result_cache_get(key, freshness=None):
+    # Given a freshness token, an entry stored under a token is fresh exactly when the tokens match; the TTL
+    # only applies otherwise
+    cache = _result_cache()
+    with cache['lock']:
+        entry = cache['entries'].get(key)
+        expired = entry is not None and time.time() - entry['stored_at'] > RESULT_CACHE_TTL_SECONDS
+        if entry is not None and freshness is not None and entry['freshness'] is not None:
+            expired = entry['freshness'] != freshness
+        if expired:
+            cache['entries'].pop(key)
+            cache['bytes'] -= entry['nbytes']
+            entry = None
+        if entry is None:
+            cache['misses'] += 1
+            return None
+        cache['entries'].move_to_end(key)
+        cache['hits'] += 1
+        value = entry['value']
+    # Callers are free to mutate what they get back (set_index(inplace=True) etc.)
+    return value.copy() if isinstance(value, pd.DataFrame) else value
+
+
+def result_cache_put(key, value, source=None, freshness=None):
+    nbytes = _result_nbytes(value)
+    if nbytes > RESULT_CACHE_MAX_BYTES:
+        return
+    cache = _result_cache()
+    with cache['lock']:
+        previous = cache['entries'].pop(key, None)
+        if previous is not None:
+            cache['bytes'] -= previous['nbytes']
+        cache['entries'][key] = {'value': value, 'nbytes': nbytes, 'stored_at': time.time(), 'source': source,
+                                 'freshness': freshness}
+        cache['bytes'] += nbytes
+        # Evict least recently used entries until we are back under the byte budget
+        while cache['bytes'] > RESULT_CACHE_MAX_BYTES:
+            _, evicted = cache['entries'].popitem(last=False)
+            cache['bytes'] -= evicted['nbytes']
+            cache['evictions'] += 1
+
+
+def invalidate_result_cache(conn_config=None, query_config=None):
+    # No arguments clears everything; otherwise drop entries for a connection and/or a query
+    fingerprint = connection_fingerprint(conn_config) if conn_config else None
+    source = normalize_sql(build_query_sql(query_config)) if query_config else None
+    cache = _result_cache()
+    with cache['lock']:
+        for key in list(cache['entries']):
+            entry = cache['entries'][key]
+            if fingerprint and key[0] != fingerprint:
+                continue
+            if source and entry['source'] != source:
+                continue
+            cache['entries'].pop(key)
+            cache['bytes'] -= entry['nbytes']
+
+
+def get_result_cache_stats():
+    cache = _result_cache()
+    with cache['lock']:
+        return {
+            'entries': len(cache['entries']),
+            'megabytes': round(cache['bytes'] / 2 ** 20, 2),
+            'hits': cache['hits'],
+            'misses': cache['misses'],
+            'evictions': cache['evictions'],
+        }
+
+
+def get_query_connection(query_config, connections):
     if 'connection_id' not in query_config:
         st.error("Connection not specified for query.")
         return None
@@ -40,29 +596,73 @@ def run_query(query_config, connections, full_fetch=False, count_only=False):
     if not conn_config:
         st.error("Selected connection configuration not found.")
         return None
+    return conn_config
+
 
-    # Build SQL statement
+def build_query_sql(query_config, count_only=False):
     if count_only:
         sql = f"SELECT COUNT(*) FROM ({query_config['base_sql']}) AS subquery"
         if query_config.get('filter'):
             sql = f"SELECT COUNT(*) FROM ({query_config['base_sql']} WHERE {query_config['filter']}) AS subquery"
-         #Set full_fetch to true since we're counting the rows, not fetching data
+        return sql
+    sql = query_config['base_sql']
+    if query_config.get('filter'):
+        sql += f" WHERE {query_config['filter']}"
+    return sql
+
+
+def project_sql(sql, conn_config, columns=None):
+    # Only the listed columns leave the warehouse; no columns means all of them
+    if not columns:
+        return sql
+    quoted = ", ".join(quote_identifier(conn_config, column) for column in dict.fromkeys(columns))
+    return f"SELECT {quoted} FROM ({sql}) AS q"
+
+
+def execute_query(query_config, conn_config, full_fetch=False, count_only=False, fetch_mode='pandas',
+                  use_cache=True, columns=None):
+    # Core of run_query without any Streamlit calls, safe to use from worker threads.
+    # Raises on failure and returns the (possibly empty) DataFrame, or the count for count_only.
+    sql = build_query_sql(query_config, count_only)
+    if not count_only:
+        sql = project_sql(sql, conn_config, columns)
+    if count_only:
+        # Set full_fetch to true since we're counting the rows, not fetching data
         full_fetch = True
-    else:
-        sql = query_config['base_sql']
-        if query_config.get('filter'):
-            sql += f" WHERE {query_config['filter']}"
 
-    try:
-        # Use sample_size to control data fetching based on full_fetch flag
-        sample_size = None if full_fetch else 5  # Change 5 to your desired sample size for display
+    # Use sample_size to control data fetching based on full_fetch flag
+    sample_size = None if full_fetch else 5  # Change 5 to your desired sample size for display
+
+    cache_key = (connection_fingerprint(conn_config), normalize_sql(sql), fetch_mode, sample_size)
+    # Probed before fetching, so a change made meanwhile shows up as a new token on the next run
+    freshness = None
+    if use_cache and query_config.get('check_freshness'):
+        freshness = query_freshness(query_config, conn_config)
+    df = result_cache_get(cache_key, freshness) if use_cache else None
+    # Full Arrow fetches of the whole result are what snapshots store, only those can be incremental
+    incremental = (full_fetch and not count_only and not columns and fetch_mode == 'arrow'
+                   and query_config.get('watermark_column'))
+    if df is None:
+        if incremental:
+            df = fetch_incremental(query_config, conn_config)
+        else:
+            df = fetch_data(sql, conn_config, sample_size, fetch_mode=fetch_mode)
+        result_cache_put(cache_key, df, source=normalize_sql(build_query_sql(query_config)), freshness=freshness)
+    if count_only and not df.empty:
+        return df.iloc[0, 0]  # Return the count value from the result
+    return df
 
-        df = fetch_data(sql, conn_config, sample_size)
 
-        if df is not None and not df.empty:
-            if count_only:
-                return df.iloc[0, 0]  # Return the count value from the result
-            return df
+def run_query(query_config, connections, full_fetch=False, count_only=False, fetch_mode='pandas', use_cache=True,
+              columns=None):
+    conn_config = get_query_connection(query_config, connections)
+    if not conn_config:
+        return None
+
+    try:
+        result = execute_query(query_config, conn_config, full_fetch, count_only, fetch_mode, use_cache, columns)
+        if not isinstance(result, pd.DataFrame) or not result.empty:
+            return result
 
         st.warning("Query did not return any rows.")
         return None
@@ -71,6 +671,566 @@ def run_query(query_config, connections, full_fetch=False, count_only=False):
         return None
 
 
+# Schema discovery: column names and types from a zero-row query. Drivers that report no types (SQLite) get
+# them inferred from a small sample instead.
+SCHEMA_SAMPLE_ROWS = 100
+NUMERIC_TYPE_PATTERN = re.compile(
+    r'^(?:U?(?:TINY|SMALL|BIG|HUGE)?INT(?:EGER)?\d*|NUMBER|NUMERIC|DECIMAL|FIXED|REAL|FLOAT\d*|DOUBLE)\b', re.I)
+
+
+def _description_type_name(type_code, dialect_name):
+    if type_code is None:
+        return None
+    if dialect_name == 'snowflake' and isinstance(type_code, int):
+        try:
+            from snowflake.connector.constants import FIELD_ID_TO_NAME
+        except ImportError:
+            return str(type_code)
+        return FIELD_ID_TO_NAME.get(type_code, str(type_code))
+    return str(type_code)
+
+
+def summable_columns(df):
+    return [column for column in df.columns
+            if pd.api.types.is_numeric_dtype(df[column]) and not pd.api.types.is_bool_dtype(df[column])]
+
+
+def fetch_query_schema(query_config, conn_config, use_cache=True):
+    # DataFrame with one row per result column: column, type and whether it is numeric
+    sql = build_query_sql(query_config)
+    cache_key = (connection_fingerprint(conn_config), normalize_sql(sql), 'schema', 0)
+    schema = result_cache_get(cache_key) if use_cache else None
+    if schema is not None:
+        return schema
+    engine = get_sqlalchemy_engine(conn_config)
+    with engine.connect() as connection:
+        result = connection.execute(text(f"SELECT * FROM ({sql}) AS q WHERE 1 = 0"))
+        names = list(result.keys())
+        types = [_description_type_name(column[1], engine.dialect.name) for column in result.cursor.description]
+        result.close()
+    if None in types:
+        sample = fetch_data(sql, conn_config, SCHEMA_SAMPLE_ROWS, fetch_mode='arrow')
+        numeric = set(summable_columns(sample))
+        schema = pd.DataFrame({'column': list(sample.columns), 'type': [str(dtype) for dtype in sample.dtypes],
+                               'numeric': [column in numeric for column in sample.columns]})
+    else:
+        schema = pd.DataFrame({'column': names, 'type': types,
+                               'numeric': [bool(NUMERIC_TYPE_PATTERN.match(name)) for name in types]})
+    result_cache_put(cache_key, schema, source=normalize_sql(sql))
+    return schema
+
+
+def get_query_schema(query_config, connections, use_cache=True):
+    conn_config = get_query_connection(query_config, connections)
+    if not conn_config:
+        return None
+    try:
+        return fetch_query_schema(query_config, conn_config, use_cache)
+    except Exception as e:
+        st.error(f"Could not read the columns of {query_config['name']}: {e}")
+        return None
+
+
+# Default cap on concurrent queries per warehouse during a parallel group refresh
+DEFAULT_MAX_CONCURRENCY = 4
+REFRESH_MAX_WORKERS = 16
+
+
+def _warehouse_key(conn_config):
+    if '://' in (conn_config.get('url') or ''):
+        return conn_config['url']
+    return f"{conn_config.get('account')}/{conn_config.get('warehouse')}"
+
+
+def refresh_queries_parallel(query_configs, connections, on_progress=None, full_fetch=False, fetch_mode='pandas'):
+    # Runs the queries concurrently, never more than max_concurrency at a time on the same warehouse.
+    # Returns (results, errors): results is aligned with query_configs, errors is a list of (query, message).
+    # on_progress(done, total, query, error) is called from the calling thread as each query finishes.
+    results = [None] * len(query_configs)
+    errors = []
+    semaphores = {}
+    jobs = []
+    for position, query in enumerate(query_configs):
+        conn_config = next((conn for conn in connections if conn['id'] == query.get('connection_id')), None)
+        if not conn_config:
+            errors.append((query, "Selected connection configuration not found."))
+            continue
+        warehouse = _warehouse_key(conn_config)
+        limit = int(conn_config.get('max_concurrency') or DEFAULT_MAX_CONCURRENCY)
+        semaphores.setdefault(warehouse, threading.BoundedSemaphore(limit))
+        jobs.append((position, query, conn_config, semaphores[warehouse]))
+
+    def run(query, conn_config, semaphore):
+        with semaphore:
+            return execute_query(query, conn_config, full_fetch=full_fetch, fetch_mode=fetch_mode)
+
+    done = len(errors)
+    total = len(query_configs)
+    for query, message in errors:
+        if on_progress:
+            on_progress(done, total, query, message)
+    if not jobs:
+        return results, errors
+    with ThreadPoolExecutor(max_workers=min(REFRESH_MAX_WORKERS, len(jobs))) as executor:
+        futures = {executor.submit(run, query, conn_config, semaphore): (position, query)
+                   for position, query, conn_config, semaphore in jobs}
+        for future in as_completed(futures):
+            position, query = futures[future]
+            error = None
+            try:
+                results[position] = future.result()
+            except Exception as e:
+                error = str(e)
+                errors.append((query, error))
+            done += 1
+            if on_progress:
+                on_progress(done, total, query, error)
+    return results, errors
+
+
+def run_query_batches(query_config, connections, chunk_rows=STREAM_CHUNK_ROWS, chunk_bytes=None, columns=None):
+    # Like run_query_stream but yields Arrow tables for consumers that never need pandas
+    conn_config = get_query_connection(query_config, connections)
+    if not conn_config:
+        return
+    sql = project_sql(build_query_sql(query_config), conn_config, columns)
+    yield from stream_record_batches(sql, conn_config, chunk_rows, chunk_bytes)
+
+
+def run_query_stream(query_config, connections, chunk_rows=STREAM_CHUNK_ROWS, chunk_bytes=None, fetch_mode='arrow',
+                     columns=None):
+    # Streaming counterpart of run_query(..., full_fetch=True); errors surface to the consumer
+    conn_config = get_query_connection(query_config, connections)
+    if not conn_config:
+        return
+    sql = project_sql(build_query_sql(query_config), conn_config, columns)
+    yield from stream_data(sql, conn_config, chunk_rows, chunk_bytes, fetch_mode)
+
+
+# Snapshot store: full query results persisted as zstd Parquet under
+# SNAPSHOT_DIR/<query id>/<sql hash>/<UTC timestamp>.parquet, so a new session can show them without a query
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots')
+SNAPSHOT_TIMESTAMP_FORMAT = '%Y%m%dT%H%M%S%fZ'
+# Retention: newest snapshots kept per query, maximum age and total size. The newest snapshot of a query is
+# only removed by the size budget or when the query no longer exists.
+SNAPSHOT_KEEP_PER_QUERY = 5
+SNAPSHOT_MAX_AGE_DAYS = 30
+SNAPSHOT_MAX_BYTES = 5 * 2 ** 30
+# Rows shown when a snapshot is previewed on the dashboard
+SNAPSHOT_PREVIEW_ROWS = 1000
+
+
+def query_id(query_config):
+    # Queries created before ids existed get one derived from their name, stable across sessions
+    if not query_config.get('id'):
+        query_config['id'] = hashlib.sha256(query_config['name'].encode('utf-8')).hexdigest()[:12]
+    return query_config['id']
+
+
+def snapshot_sql_hash(query_config, conn_config):
+    # Editing the SQL or pointing the query at another connection starts a new snapshot series
+    source = f"{connection_fingerprint(conn_config)}\n{normalize_sql(build_query_sql(query_config))}"
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+
+
+def save_snapshot(query_config, conn_config, data, metadata=None, directory=SNAPSHOT_DIR):
+    table = data if isinstance(data, pa.Table) else pa.Table.from_pandas(data, preserve_index=False)
+    created_at = datetime.datetime.now(datetime.timezone.utc)
+    info = {'query_name': query_config['name'], 'sql': build_query_sql(query_config),
+            'created_at': created_at.isoformat(), **(metadata or {})}
+    if query_config.get('watermark_column'):
+        info['watermark'] = table_watermark(table, query_config['watermark_column'])
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           b'snapshot': json.dumps(info, default=str).encode('utf-8')})
+    folder = os.path.join(directory, query_id(query_config), snapshot_sql_hash(query_config, conn_config))
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{created_at.strftime(SNAPSHOT_TIMESTAMP_FORMAT)}.parquet")
+    # Write next to the target and rename, readers never see a half-written file
+    pq.write_table(table, f"{path}.tmp", compression='zstd')
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def list_snapshots(query_config=None, directory=SNAPSHOT_DIR):
+    # One row per snapshot file, newest first. Only the file names and sizes are read.
+    records = []
+    if query_config:
+        query_ids = [query_id(query_config)]
+    else:
+        query_ids = os.listdir(directory) if os.path.isdir(directory) else []
+    for snapshot_query in query_ids:
+        query_folder = os.path.join(directory, snapshot_query)
+        if not os.path.isdir(query_folder):
+            continue
+        for sql_hash in os.listdir(query_folder):
+            for name in os.listdir(os.path.join(query_folder, sql_hash)):
+                if not name.endswith('.parquet'):
+                    continue
+                path = os.path.join(query_folder, sql_hash, name)
+                created_at = datetime.datetime.strptime(name[:-len('.parquet')], SNAPSHOT_TIMESTAMP_FORMAT)
+                records.append({'query_id': snapshot_query, 'sql_hash': sql_hash,
+                                'created_at': created_at.replace(tzinfo=datetime.timezone.utc),
+                                'bytes': os.path.getsize(path), 'path': path})
+    snapshots = pd.DataFrame(records, columns=['query_id', 'sql_hash', 'created_at', 'bytes', 'path'])
+    return snapshots.sort_values('created_at', ascending=False, ignore_index=True)
+
+
+def latest_snapshot(query_config, conn_config, directory=SNAPSHOT_DIR):
+    # Path of the newest snapshot taken with the query's current SQL and connection, or None
+    snapshots = list_snapshots(query_config, directory)
+    snapshots = snapshots[snapshots['sql_hash'] == snapshot_sql_hash(query_config, conn_config)]
+    return snapshots['path'].iloc[0] if len(snapshots) else None
+
+
+def snapshot_info(path):
+    # Footer only: row count and the metadata written with the snapshot
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.schema_arrow.metadata or {}
+    info = json.loads(metadata.get(b'snapshot', b'{}'))
+    info['rows'] = parquet_file.metadata.num_rows
+    return info
+
+
+def load_snapshot(path, columns=None):
+    # Memory-mapped read, only the requested columns are touched
+    return pq.read_table(path, columns=columns, memory_map=True).to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def preview_snapshot(path, rows=SNAPSHOT_PREVIEW_ROWS):
+    # First rows only, the rest of the file is never read
+    batches = pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=rows)
+    batch = next(batches, None)
+    if batch is None:
+        return load_snapshot(path)
+    return batch.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def gc_snapshots(keep=SNAPSHOT_KEEP_PER_QUERY, max_age_days=SNAPSHOT_MAX_AGE_DAYS, max_bytes=SNAPSHOT_MAX_BYTES,
+                 live_query_ids=None, directory=SNAPSHOT_DIR):
+    # Applies the retention policy and returns the removed paths
+    snapshots = list_snapshots(directory=directory)
+    if snapshots.empty:
+        return []
+    newest = snapshots.groupby('query_id').cumcount()
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=max_age_days)
+    expired = (newest >= keep) | ((newest > 0) & (snapshots['created_at'] < cutoff))
+    if live_query_ids is not None:
+        expired |= ~snapshots['query_id'].isin(list(live_query_ids))
+    # Over the size budget: drop the oldest of what is left, latest snapshots last
+    kept = snapshots[~expired].sort_values(['created_at'], ascending=True)
+    kept = pd.concat([kept[newest[kept.index] > 0], kept[newest[kept.index] == 0]])
+    excess = snapshots.loc[~expired, 'bytes'].sum() - max_bytes
+    for index, size in kept['bytes'].items():
+        if excess <= 0:
+            break
+        expired[index] = True
+        excess -= size
+    removed = snapshots.loc[expired, 'path'].tolist()
+    for path in removed:
+        os.remove(path)
+    for folder, _, _ in sorted(os.walk(directory), reverse=True):
+        if folder != directory and not os.listdir(folder):
+            os.rmdir(folder)
+    return removed
+
+
+@st.cache_resource
+def _background_refreshes():
+    # Shared by all sessions: one entry per refresh job, updated by its worker thread
+    return {'jobs': {}, 'lock': threading.Lock()}
+
+
+def session_id():
+    # Random id of the browser session, for keys in registries shared by all sessions
+    if 'session_id' not in st.session_state:
+        st.session_state['session_id'] = uuid.uuid4().hex
+    return st.session_state['session_id']
+
+
+def start_background_refresh(job_key, query_configs, connections):
+    # Refreshes the queries in a worker thread and stores every result as a snapshot. Returns False if the
+    # job is still running from an earlier start.
+    registry = _background_refreshes()
+    with registry['lock']:
+        job = registry['jobs'].get(job_key)
+        if job and not job['finished_at']:
+            return False
+        job = {'started_at': time.time(), 'finished_at': None, 'done': 0, 'total': len(query_configs),
+               'errors': []}
+        registry['jobs'][job_key] = job
+    # Copies, the session may edit its queries while the thread runs
+    query_configs = [dict(query) for query in query_configs]
+    connections = [dict(conn) for conn in connections]
+
+    def on_progress(done, total, query, error):
+        job['done'] = done
+
+    def run():
+        try:
+            results, errors = refresh_queries_parallel(query_configs, connections, on_progress=on_progress,
+                                                       full_fetch=True, fetch_mode='arrow')
+            for query, result in zip(query_configs, results):
+                if result is not None:
+                    conn_config = next(conn for conn in connections if conn['id'] == query['connection_id'])
+                    save_snapshot(query, conn_config, result)
+            job['errors'] = [(query['name'], message) for query, message in errors]
+        except Exception as e:
+            job['errors'].append(('', str(e)))
+        finally:
+            job['finished_at'] = time.time()
+
+    threading.Thread(target=run, name=f"refresh-{job_key}", daemon=True).start()
+    return True
+
+
+def get_background_refresh(job_key):
+    with _background_refreshes()['lock']:
+        job = _background_refreshes()['jobs'].get(job_key)
+        return dict(job) if job else None
+
+
+def render_background_refresh(job_key):
+    job = get_background_refresh(job_key)
+    if not job:
+        return
+    if not job['finished_at']:
+        st.info(f"Background refresh running: {job['done']}/{job['total']} queries done.")
+        return
+    finished = datetime.datetime.fromtimestamp(job['finished_at']).strftime("%Y-%m-%d %H:%M:%S")
+    st.caption(f"Background refresh finished at {finished}.")
+    for name, message in job['errors']:
+        st.write(f"- **{name}**: {message}")
+
+
+# Incremental refresh: queries with a watermark column fetch only rows beyond the watermark of their latest
+# snapshot and merge them into it. With merge keys the delta is upserted, otherwise appended. Rows deleted
+# in the warehouse are not noticed until the next full refresh.
+def _encode_watermark(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return {'type': 'datetime', 'value': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'type': 'date', 'value': value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {'type': 'decimal', 'value': str(value)}
+    if isinstance(value, numbers.Number):
+        return {'type': 'number', 'value': value}
+    return {'type': 'string', 'value': str(value)}
+
+
+def _decode_watermark(watermark):
+    kind, value = watermark['type'], watermark['value']
+    if kind == 'datetime':
+        return datetime.datetime.fromisoformat(value)
+    if kind == 'date':
+        return datetime.date.fromisoformat(value)
+    if kind == 'decimal':
+        return decimal.Decimal(value)
+    return value
+
+
+def table_watermark(table, column):
+    return _encode_watermark(pc.max(table[column]).as_py()) if column in table.column_names else None
+
+
+def fetch_incremental(query_config, conn_config):
+    # Latest snapshot plus the rows beyond its watermark. Falls back to a full fetch when there is no usable
+    # snapshot or the columns changed.
+    sql = build_query_sql(query_config)
+    column, merge_keys = query_config['watermark_column'], list(query_config.get('merge_keys') or [])
+    path = latest_snapshot(query_config, conn_config)
+    watermark = snapshot_info(path).get('watermark') if path else None
+    if not watermark:
+        return fetch_data(sql, conn_config, fetch_mode='arrow')
+    base = pq.read_table(path, memory_map=True)
+    # Upserts re-read the boundary value, rows written later with the same watermark are not lost
+    operator = '>=' if merge_keys else '>'
+    statement = text(f"SELECT * FROM ({sql}) AS q WHERE {quote_identifier(conn_config, column)} {operator} :watermark")
+    with get_sqlalchemy_engine(conn_config).connect() as connection:
+        result = connection.execute(statement, {'watermark': _decode_watermark(watermark)})
+        names = list(result.keys())
+        rows = [tuple(row) for row in result]
+    if names != base.column_names:
+        return fetch_data(sql, conn_config, fetch_mode='arrow')
+    delta = pa.Table.from_batches([_rows_to_record_batch(rows, names, base.schema)])
+    merged = pa.concat_tables([base, delta], promote_options='permissive').to_pandas(types_mapper=pd.ArrowDtype)
+    if merge_keys:
+        merged = merged.drop_duplicates(subset=merge_keys, keep='last', ignore_index=True)
+    merged.attrs['delta_rows'] = len(rows)
+    return merged
+
+
+# Freshness checks: a query's freshness token describes the state of the tables it reads. A cached count
+# or result stored under the same token is served without re-querying, however old it is. Snowflake tables
+# are looked up in INFORMATION_SCHEMA (LAST_ALTERED and ROW_COUNT); local stand-ins have no such metadata
+# and need a freshness probe SQL on the query. Queries reading views, or anything the lookup cannot
+# resolve, get no token and are always re-queried.
+_IDENTIFIER_PART = r'(?:"[^"]+"|[A-Za-z_][\w$]*)'
+TABLE_REFERENCE_PATTERN = re.compile(rf'\b(?:FROM|JOIN)\s+({_IDENTIFIER_PART}(?:\s*\.\s*{_IDENTIFIER_PART}){{0,2}})',
+                                     re.IGNORECASE)
+CTE_NAME_PATTERN = re.compile(r'\b([A-Za-z_][\w$]*)\s+AS\s*\(', re.IGNORECASE)
+
+
+def _normalize_identifier(part):
+    # Snowflake stores unquoted identifiers in upper case and quoted ones as written
+    part = part.strip()
+    return part[1:-1].replace('""', '"') if part.startswith('"') else part.upper()
+
+
+def query_tables(sql):
+    # (database, schema, table) for every table the SQL reads, None parts resolve to the connection defaults
+    cte_names = {name.upper() for name in CTE_NAME_PATTERN.findall(sql)}
+    tables = set()
+    for reference in TABLE_REFERENCE_PATTERN.findall(sql):
+        parts = [_normalize_identifier(part) for part in re.findall(_IDENTIFIER_PART, reference)]
+        if len(parts) == 1 and parts[0] in cte_names:
+            continue
+        tables.add(tuple([None] * (3 - len(parts)) + parts))
+    return sorted(tables, key=str)
+
+
+def _resolve_table(conn_config, table):
+    database, schema, name = table
+    return ((database or (conn_config.get('database') or '').upper()),
+            (schema or (conn_config.get('schema') or '').upper()), name)
+
+
+def fetch_table_freshness(conn_config, tables):
+    # {(database, schema, table): (last_altered, row_count)} in one INFORMATION_SCHEMA query per database.
+    # Views are left out, their LAST_ALTERED only tracks the view definition.
+    by_database = {}
+    for table in {_resolve_table(conn_config, table) for table in tables}:
+        by_database.setdefault(table[0], set()).add(table)
+    states = {}
+    with get_sqlalchemy_engine(conn_config).connect() as connection:
+        for database, database_tables in by_database.items():
+            statement = text(
+                f'SELECT TABLE_SCHEMA, TABLE_NAME, LAST_ALTERED, ROW_COUNT '
+                f'FROM "{database.replace(chr(34), chr(34) * 2)}".INFORMATION_SCHEMA.TABLES '
+                f"WHERE TABLE_TYPE <> 'VIEW' AND TABLE_SCHEMA IN :schemas AND TABLE_NAME IN :names"
+            ).bindparams(bindparam('schemas', expanding=True), bindparam('names', expanding=True))
+            rows = connection.execute(statement, {'schemas': sorted({table[1] for table in database_tables}),
+                                                  'names': sorted({table[2] for table in database_tables})})
+            for schema, name, last_altered, row_count in rows:
+                if (database, schema, name) in database_tables:
+                    states[(database, schema, name)] = (str(last_altered), row_count)
+    return states
+
+
+def query_freshness(query_config, conn_config, table_states=None):
+    # Freshness token for the query, or None when its freshness cannot be told.
+    # table_states lets callers share one fetch_table_freshness lookup between many queries.
+    try:
+        if query_config.get('freshness_sql'):
+            with get_sqlalchemy_engine(conn_config).connect() as connection:
+                rows = connection.execute(text(query_config['freshness_sql'])).fetchall()
+            return json.dumps([list(row) for row in rows], default=str)
+        if '://' in (conn_config.get('url') or ''):
+            return None
+        tables = [_resolve_table(conn_config, table) for table in query_tables(build_query_sql(query_config))]
+        if table_states is None:
+            table_states = fetch_table_freshness(conn_config, tables)
+    except Exception:
+        # A failing probe must not block the query itself
+        return None
+    if not tables or any(table not in table_states for table in tables):
+        return None
+    return json.dumps([[list(table), list(table_states[table])] for table in tables], default=str)
+
+
+def batch_query_freshness(query_configs, connections):
+    # Freshness tokens aligned with query_configs, None for queries without freshness checks.
+    # Tables of all Snowflake queries on one connection are looked up together.
+    freshness = [None] * len(query_configs)
+    lookups = {}
+    for position, query in enumerate(query_configs):
+        conn_config = next((conn for conn in connections if conn['id'] == query.get('connection_id')), None)
+        if not conn_config or not query.get('check_freshness'):
+            continue
+        if query.get('freshness_sql') or '://' in (conn_config.get('url') or ''):
+            freshness[position] = query_freshness(query, conn_config)
+            continue
+        lookup = lookups.setdefault(connection_fingerprint(conn_config), (conn_config, []))
+        lookup[1].append(position)
+    for conn_config, positions in lookups.values():
+        tables = {table for position in positions for table in query_tables(build_query_sql(query_configs[position]))}
+        try:
+            table_states = fetch_table_freshness(conn_config, tables)
+        except Exception:
+            continue
+        for position in positions:
+            freshness[position] = query_freshness(query_configs[position], conn_config, table_states)
+    return freshness
+
+
+# Upper bound on the number of counts combined into one UNION ALL statement
+BATCH_COUNT_MAX_QUERIES = 100
+
+
+def _count_cache_key(query_config, conn_config):
+    # Same key run_query(..., count_only=True) uses, so both paths share cached counts
+    return (connection_fingerprint(conn_config), normalize_sql(build_query_sql(query_config, count_only=True)),
+            'pandas', None)
+
+
+def _fetch_counts_union(query_configs, conn_config):
+    selects = [
+        f"SELECT {index} AS query_index, COUNT(*) AS row_count FROM ({build_query_sql(query)}) AS q{index}"
+        for index, query in enumerate(query_configs)
+    ]
+    engine = get_sqlalchemy_engine(conn_config)
+    with engine.connect() as connection:
+        rows = connection.execute(text(" UNION ALL ".join(selects))).fetchall()
+    return {int(index): int(count) for index, count in rows}
+
+
+def fetch_batch_counts(query_configs, connections, use_cache=True):
+    # Counts every query in one UNION ALL round trip per connection.
+    # Returns (counts, errors), both aligned with query_configs; failed entries are None / an error message.
+    counts = [None] * len(query_configs)
+    errors = [None] * len(query_configs)
+    freshness = [None] * len(query_configs)
+    if use_cache:
+        freshness = batch_query_freshness(query_configs, connections)
+    pending = {}
+    for position, query in enumerate(query_configs):
+        conn_config = next((conn for conn in connections if conn['id'] == query.get('connection_id')), None)
+        if not conn_config:
+            errors[position] = "Selected connection configuration not found."
+            continue
+        cached = result_cache_get(_count_cache_key(query, conn_config), freshness[position]) if use_cache else None
+        if cached is not None:
+            counts[position] = cached.iloc[0, 0]
+            continue
+        fingerprint = connection_fingerprint(conn_config)
+        pending.setdefault(fingerprint, (conn_config, []))[1].append(position)
+
+    for conn_config, positions in pending.values():
+        for start in range(0, len(positions), BATCH_COUNT_MAX_QUERIES):
+            batch = positions[start:start + BATCH_COUNT_MAX_QUERIES]
+            batch_queries = [query_configs[position] for position in batch]
+            try:
+                batch_counts = _fetch_counts_union(batch_queries, conn_config)
+            except Exception:
+                # One broken query fails the whole UNION, so fall back to counting one by one
+                batch_counts = {}
+                for index, query in enumerate(batch_queries):
+                    try:
+                        batch_counts[index] = get_row_count(build_query_sql(query), conn_config,
+                                                            freshness[batch[index]])
+                    except Exception as e:
+                        errors[batch[index]] = str(e)
+            for index, position in enumerate(batch):
+                if index in batch_counts:
+                    counts[position] = batch_counts[index]
+                    result_cache_put(_count_cache_key(query_configs[position], conn_config),
+                                     pd.DataFrame({'row_count': [batch_counts[index]]}),
+                                     source=normalize_sql(build_query_sql(query_configs[position])),
+                                     freshness=freshness[position])
+    return counts, errors
+
+
 def run_query2(query_config, connections, full_fetch=False):
     if 'connection_id' not in query_config:
         st.error("Connection not specified for query.")
@@ -97,22 +1257,28 @@ def run_query2(query_config, connections, full_fetch=False):
         st.error(f"Test failed: {e}")
         return None
 
-def fetch_count_data(sql_query, conn_config, full_fetch=False):
+def fetch_count_data(sql_query, conn_config, full_fetch=False, freshness=None):
+    # With a freshness token (see query_freshness) a count cached under the same token is returned as is.
+    # The key matches _count_cache_key, so counts are shared with run_query and fetch_batch_counts.
+    cache_key = (connection_fingerprint(conn_config),
+                 normalize_sql(f"SELECT COUNT(*) FROM ({sql_query}) AS subquery"), 'pandas', None)
+    if freshness is not None:
+        cached = result_cache_get(cache_key, freshness)
+        if cached is not None:
+            return cached.iloc[0, 0]
     engine = get_sqlalchemy_engine(conn_config)
     with engine.connect() as connection:
         query = f"SELECT COUNT(*) AS row_count FROM ({sql_query}) AS subquery"
         result = connection.execute(text(query))
         count = result.scalar()
+    if freshness is not None:
+        result_cache_put(cache_key, pd.DataFrame({'row_count': [count]}), source=normalize_sql(sql_query),
+                         freshness=freshness)
     return count
 
 
-def get_row_count(sql_query, conn_config):
-    engine = get_sqlalchemy_engine(conn_config)
-    count_query = f"SELECT COUNT(*) FROM ({sql_query}) AS total"
-    with engine.connect() as connection:
-        result = connection.execute(text(count_query))
-        row_count = result.scalar()
-    return row_count
+def get_row_count(sql_query, conn_config, freshness=None):
+    return fetch_count_data(sql_query, conn_config, freshness=freshness)
 
     # Function to compare two DataFrames based on selected columns
 
@@ -133,24 +1299,20 @@ def compare_dataframes2(df1, df2, column_1, column_2, use_primary=True):
 
     return df1_common[differences].reset_index(drop=True), df2_common[differences].reset_index(drop=True)
 
-def compare_dataframes(df1, df2, column_1, column_2, use_primary=True):
+def compare_dataframes(df1, df2, column_1, column_2, use_primary=True, rule=None):
+    rules = {column_1: rule} if rule else None
     if use_primary:
-        # Align using primary keys
-        common_index = df1.index.intersection(df2.index)
-        df1_common = df1.loc[common_index, column_1]
-        df2_common = df2.loc[common_index, column_2]
-        differences = df1_common != df2_common
-        return df1_common[differences], df2_common[differences]
+        # Align using primary keys through the hash diff engine
+        key_1 = df1.index.name or 'index'
+        key_2 = df2.index.name or 'index'
+        result = hash_diff(df1[[column_1]].reset_index(names=key_1), df2[[column_2]].reset_index(names=key_2),
+                           [key_1], [key_2], [column_1], [column_2], rules)
+        changed = result['changed'].set_index(key_1)
+        return changed[f'{column_1}{DIFF_SUFFIX_1}'], changed[f'{column_2}{DIFF_SUFFIX_2}']
     else:
-        # Optimal comparison using set operations
-        df1_values = set(df1[column_1])
-        df2_values = set(df2[column_2])
-
-        # Find differences using set operations
-        df1_unique = list(df1_values - df2_values)
-        df2_unique = list(df2_values - df1_values)
-
-        return pd.Series(df1_unique), pd.Series(df2_unique)
+        # Multiset comparison: values that occur more often on one side than on the other
+        result = multiset_diff(df1, df2, [column_1], [column_2], rules=rules)
+        return result['removed'][column_1], result['added'][column_2]
 
 # Example usage
 # df1 = pd.DataFrame({'A': [1, 2, 3, 4]})
@@ -158,6 +1320,1265 @@ def compare_dataframes(df1, df2, column_1, column_2, use_primary=True):
 # print(compare_dataframes(df1, df2, 'A', 'B', use_primary=False))
 
 
+# Suffixes for the two sides of a compared column in a diff result
+DIFF_SUFFIX_1 = '_1'
+DIFF_SUFFIX_2 = '_2'
+
+
+def _align_compare_dtypes(series_1, series_2):
+    # Equal values must hash equally on both sides, so bring mismatched dtypes to a common one
+    if series_1.dtype == series_2.dtype:
+        return series_1, series_2
+    if pd.api.types.is_numeric_dtype(series_1) and pd.api.types.is_numeric_dtype(series_2):
+        # Integers stay integers (float64 is exact only up to 2**53); a float side joins them when it only
+        # holds whole numbers
+        if all(_holds_integers(series) for series in (series_1, series_2)):
+            try:
+                return series_1.astype('Int64'), series_2.astype('Int64')
+            except (TypeError, ValueError, OverflowError):
+                pass
+        return series_1.astype('float64'), series_2.astype('float64')
+    return series_1.astype('string'), series_2.astype('string')
+
+
+def _holds_integers(series):
+    if pd.api.types.is_bool_dtype(series):
+        return False
+    if pd.api.types.is_integer_dtype(series):
+        return True
+    values = series.dropna().to_numpy(dtype='float64')
+    return bool(np.all(np.isfinite(values) & (values == np.round(values))))
+
+
+# Per-column comparison rules, keyed by the column of the first query. Missing settings fall back to these.
+DEFAULT_COMPARE_RULE = {
+    'abs_tolerance': 0.0,
+    'rel_tolerance': 0.0,
+    'time_tolerance_seconds': 0.0,
+    'ignore_case': False,
+    'trim_whitespace': False,
+    'null_equals_null': True,
+}
+
+
+def compare_rule(rules, column):
+    return {**DEFAULT_COMPARE_RULE, **((rules or {}).get(column) or {})}
+
+
+def _rule_needs_direct_compare(rule):
+    # Tolerances and NULL != NULL cannot be expressed through a row hash
+    return bool(rule['abs_tolerance'] or rule['rel_tolerance'] or rule['time_tolerance_seconds']
+                or not rule['null_equals_null'])
+
+
+def _normalize_compare_values(series, rule=None):
+    # Representation differences that are never real differences go first: Decimal objects become floats and
+    # timestamps become naive UTC. Case and whitespace are only dropped when the rule asks for it.
+    rule = rule or DEFAULT_COMPARE_RULE
+    if series.dtype == object:
+        present = series.dropna()
+        if len(present) and all(isinstance(value, numbers.Number) and not isinstance(value, bool)
+                                for value in present.head(100)):
+            series = pd.to_numeric(series, errors='coerce')
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return pd.to_datetime(series, utc=True).dt.tz_localize(None).astype('datetime64[us]')
+    if rule['trim_whitespace'] or rule['ignore_case']:
+        if not (pd.api.types.is_string_dtype(series) or series.dtype == object):
+            return series
+        series = series.astype('string')
+        if rule['trim_whitespace']:
+            series = series.str.strip()
+        if rule['ignore_case']:
+            series = series.str.casefold()
+    return series
+
+
+def _values_differ(series_1, series_2, rule=None):
+    # Vectorized !=, with the column's tolerances; NULL on both sides is equal unless the rule says otherwise
+    rule = rule or DEFAULT_COMPARE_RULE
+    values_1 = series_1.reset_index(drop=True)
+    values_2 = series_2.reset_index(drop=True)
+    both_null = (values_1.isna() & values_2.isna()).to_numpy()
+    if (rule['abs_tolerance'] or rule['rel_tolerance']) and pd.api.types.is_numeric_dtype(values_1) \
+            and pd.api.types.is_numeric_dtype(values_2):
+        array_1 = values_1.to_numpy(dtype='float64', na_value=np.nan)
+        array_2 = values_2.to_numpy(dtype='float64', na_value=np.nan)
+        allowed = rule['abs_tolerance'] + rule['rel_tolerance'] * np.maximum(np.abs(array_1), np.abs(array_2))
+        with np.errstate(invalid='ignore'):
+            equal = (array_1 == array_2) | (np.abs(array_1 - array_2) <= allowed)
+    elif rule['time_tolerance_seconds'] and pd.api.types.is_datetime64_any_dtype(values_1) \
+            and pd.api.types.is_datetime64_any_dtype(values_2):
+        gap = (values_1 - values_2).abs()
+        equal = (gap <= pd.Timedelta(seconds=rule['time_tolerance_seconds'])).fillna(False).to_numpy(dtype=bool)
+    else:
+        equal = (values_1 == values_2).fillna(False).to_numpy(dtype=bool)
+    if rule['null_equals_null']:
+        equal = equal | both_null
+    return ~equal
+
+
+def _row_hashes(frame):
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+
+def _key_codes_collide(keys_frame, codes):
+    # Two different key tuples with the same code on one side
+    shared = codes.duplicated(keep=False)
+    if not shared.any():
+        return False
+    subset = keys_frame[shared].assign(_code=codes[shared])
+    return subset.drop_duplicates().duplicated('_code').any()
+
+
+def encode_keys(keys_frame_1, keys_frame_2):
+    # One int64 join key per row: a single integer key column is used as-is, anything else (composite keys,
+    # strings, dates) is hashed. Returns (codes_1, codes_2), or None when two different keys share a hash.
+    if len(keys_frame_1.columns) == 1:
+        key_1, key_2 = keys_frame_1.iloc[:, 0], keys_frame_2.iloc[:, 0]
+        if (pd.api.types.is_integer_dtype(key_1) and pd.api.types.is_integer_dtype(key_2)
+                and not key_1.hasnans and not key_2.hasnans):
+            return key_1.to_numpy(dtype='int64'), key_2.to_numpy(dtype='int64')
+    codes_1 = pd.util.hash_pandas_object(keys_frame_1, index=False).astype('int64')
+    codes_2 = pd.util.hash_pandas_object(keys_frame_2, index=False).astype('int64')
+    if _key_codes_collide(keys_frame_1, codes_1) or _key_codes_collide(keys_frame_2, codes_2):
+        return None
+    return codes_1.to_numpy(), codes_2.to_numpy()
+
+
+def _join_diff_sides(left, right, keys_frame_1, keys_frame_2, codes, values_1, values_2):
+    # Outer join of the row hashes on the encoded keys, or on the key columns themselves when codes is None.
+    # Returns (merged, duplicate rows on side 1, duplicate rows on side 2).
+    if codes is not None:
+        left, right = left.assign(_key=codes[0]), right.assign(_key=codes[1])
+        join_on = ['_key']
+    else:
+        left, right = pd.concat([left, keys_frame_1], axis=1), pd.concat([right, keys_frame_2], axis=1)
+        join_on = list(keys_frame_1.columns)
+    # Duplicate keys would join every copy with every copy, pair them by occurrence instead
+    duplicates_1 = int(left.duplicated(join_on).sum())
+    duplicates_2 = int(right.duplicated(join_on).sum())
+    if duplicates_1 or duplicates_2:
+        left['_occurrence'] = _key_occurrence(left, join_on, pd.DataFrame(values_1))
+        right['_occurrence'] = _key_occurrence(right, join_on, pd.DataFrame(values_2))
+        join_on = join_on + ['_occurrence']
+    merged = left.merge(right, on=join_on, how='outer', suffixes=(DIFF_SUFFIX_1, DIFF_SUFFIX_2), indicator=True)
+    return merged, duplicates_1, duplicates_2
+
+
+def _matched_keys_differ(merged, keys_frame_1, keys_frame_2):
+    # encode_keys only catches collisions within one side; a matched pair with different key tuples is one
+    # across the sides
+    matched = merged[merged['_merge'] == 'both']
+    rows_1 = matched[f'_row{DIFF_SUFFIX_1}'].astype('int64').to_numpy()
+    rows_2 = matched[f'_row{DIFF_SUFFIX_2}'].astype('int64').to_numpy()
+    return any(_values_differ(keys_frame_1[key].iloc[rows_1], keys_frame_2[key].iloc[rows_2]).any()
+               for key in keys_frame_1.columns)
+
+
+def _key_occurrence(frame, keys, values):
+    # Rank of each row within its key, ordered by the compared values (like the ROW_NUMBER() of the pushdown
+    # comparison) so equal rows on both sides pair up
+    # values keeps the caller's index, frame has a fresh one: align by position
+    values = values.set_axis(frame.index).set_axis([f'_value_{column}' for column in values.columns], axis=1)
+    ranked = pd.concat([frame[keys], values], axis=1)
+    try:
+        ranked = ranked.sort_values(list(ranked.columns), kind='stable')
+    except TypeError:
+        # Mixed types that do not sort, fall back to the row hash
+        ranked = frame[keys + ['_hash']].sort_values(keys + ['_hash'], kind='stable')
+    return ranked.groupby(keys, sort=False, dropna=False).cumcount().reindex(frame.index).to_numpy()
+
+
+def find_duplicate_keys(df, keys, sample_size=10):
+    # Local duplicate-key check: number of duplicated keys, rows involved and the most repeated keys
+    duplicated = df.duplicated(keys, keep=False)
+    counts = df.loc[duplicated, keys].value_counts(dropna=False).rename('key_count').reset_index()
+    return {
+        'duplicate_keys': len(counts),
+        'duplicate_rows': int(duplicated.sum()),
+        'sample': counts.head(sample_size),
+    }
+
+
+def find_duplicate_keys_sql(query_config, conn_config, keys, sample_size=10):
+    # Same as find_duplicate_keys but computed in the warehouse with GROUP BY / HAVING
+    key_list = ", ".join(quote_identifier(conn_config, key) for key in keys)
+    duplicates = (f"SELECT {key_list}, COUNT(*) AS key_count FROM ({build_query_sql(query_config)}) AS q "
+                  f"GROUP BY {key_list} HAVING COUNT(*) > 1")
+    totals = fetch_data(f"SELECT COUNT(*) AS duplicate_keys, SUM(key_count) AS duplicate_rows "
+                        f"FROM ({duplicates}) AS d", conn_config).iloc[0]
+    duplicate_keys = int(totals['duplicate_keys'])
+    sample = fetch_data(f"SELECT * FROM ({duplicates}) AS d ORDER BY key_count DESC", conn_config,
+                        sample_size) if duplicate_keys else pd.DataFrame(columns=list(keys) + ['key_count'])
+    return {
+        'duplicate_keys': duplicate_keys,
+        'duplicate_rows': int(totals['duplicate_rows']) if duplicate_keys else 0,
+        'sample': sample,
+    }
+
+
+def render_duplicate_keys(duplicates, name):
+    if not duplicates['duplicate_keys']:
+        return False
+    st.warning(f"{name} has {duplicates['duplicate_keys']} duplicated keys covering {duplicates['duplicate_rows']} "
+               f"rows. Rows sharing a key are paired by occurrence instead of being joined to each other.")
+    st.write(duplicates['sample'])
+    return True
+
+
+def hash_diff(df1, df2, keys_1, keys_2, columns_1, columns_2, rules=None):
+    # Joins both sides on the (encoded) key using one 64-bit hash per row of the compared columns and only
+    # materialises full rows for keys whose hashes differ. keys_1[i] pairs with keys_2[i] and
+    # columns_1[i] is compared with columns_2[i]. Columns whose rules allow a tolerance stay out of the hash
+    # and are compared value by value on the matched rows.
+    keys_1, keys_2 = list(keys_1), list(keys_2)
+    columns_1, columns_2 = list(columns_1), list(columns_2)
+    if len(keys_1) != len(keys_2) or len(columns_1) != len(columns_2):
+        raise ValueError("Both sides need the same number of key columns and compared columns.")
+
+    values_1, values_2, column_rules = {}, {}, {}
+    for position, (column_1, column_2) in enumerate(zip(columns_1, columns_2)):
+        column_rules[position] = compare_rule(rules, column_1)
+        values_1[position], values_2[position] = _align_compare_dtypes(
+            _normalize_compare_values(df1[column_1], column_rules[position]),
+            _normalize_compare_values(df2[column_2], column_rules[position]))
+    direct = [position for position, rule in column_rules.items() if _rule_needs_direct_compare(rule)]
+    hashed = [position for position in column_rules if position not in direct]
+    keys_frame_1 = df1[keys_1].reset_index(drop=True)
+    keys_frame_2 = df2[keys_2].reset_index(drop=True)
+    keys_frame_2.columns = keys_1
+    for key in keys_1:
+        keys_frame_1[key], keys_frame_2[key] = _align_compare_dtypes(_normalize_compare_values(keys_frame_1[key]),
+                                                                     _normalize_compare_values(keys_frame_2[key]))
+
+    hashed_1 = pd.DataFrame({position: values_1[position] for position in hashed})
+    hashed_2 = pd.DataFrame({position: values_2[position] for position in hashed})
+    left = pd.DataFrame({'_hash': _row_hashes(hashed_1) if hashed else 0, '_row': np.arange(len(df1))})
+    right = pd.DataFrame({'_hash': _row_hashes(hashed_2) if hashed else 0, '_row': np.arange(len(df2))})
+    codes = encode_keys(keys_frame_1, keys_frame_2)
+    merged, duplicates_1, duplicates_2 = _join_diff_sides(left, right, keys_frame_1, keys_frame_2, codes,
+                                                          values_1, values_2)
+    if codes is not None and _matched_keys_differ(merged, keys_frame_1, keys_frame_2):
+        # Two different keys, one on each side, share a hash: join on the key columns themselves
+        merged, duplicates_1, duplicates_2 = _join_diff_sides(left, right, keys_frame_1, keys_frame_2, None,
+                                                              values_1, values_2)
+
+    both = merged['_merge'] == 'both'
+    removed = merged['_merge'] == 'left_only'
+    added = merged['_merge'] == 'right_only'
+    matched_rows = merged[both]
+    differs = (matched_rows[f'_hash{DIFF_SUFFIX_1}'] != matched_rows[f'_hash{DIFF_SUFFIX_2}']).to_numpy()
+    rows_1 = matched_rows[f'_row{DIFF_SUFFIX_1}'].astype('int64').to_numpy()
+    rows_2 = matched_rows[f'_row{DIFF_SUFFIX_2}'].astype('int64').to_numpy()
+    for position in direct:
+        differs = differs | _values_differ(values_1[position].iloc[rows_1], values_2[position].iloc[rows_2],
+                                           column_rules[position])
+    rows_1, rows_2 = rows_1[differs], rows_2[differs]
+
+    changed = keys_frame_1.iloc[rows_1].reset_index(drop=True)
+    column_mismatches = {}
+    for position, (column_1, column_2) in enumerate(zip(columns_1, columns_2)):
+        side_1 = df1[column_1].iloc[rows_1].reset_index(drop=True)
+        side_2 = df2[column_2].iloc[rows_2].reset_index(drop=True)
+        changed[f'{column_1}{DIFF_SUFFIX_1}'] = side_1
+        changed[f'{column_2}{DIFF_SUFFIX_2}'] = side_2
+        aligned_1, aligned_2 = values_1[position].iloc[rows_1], values_2[position].iloc[rows_2]
+        column_mismatches[column_1] = int(_values_differ(aligned_1, aligned_2, column_rules[position]).sum())
+
+    removed_rows = merged.loc[removed, f'_row{DIFF_SUFFIX_1}'].astype('int64').to_numpy()
+    added_rows = merged.loc[added, f'_row{DIFF_SUFFIX_2}'].astype('int64').to_numpy()
+    return {
+        'keys': keys_1,
+        'columns_1': columns_1,
+        'columns_2': columns_2,
+        'changed': changed,
+        'removed': keys_frame_1.iloc[removed_rows].reset_index(drop=True),
+        'added': keys_frame_2.iloc[added_rows].reset_index(drop=True),
+        'summary': {
+            'rows_1': len(df1),
+            'rows_2': len(df2),
+            'matched': int(both.sum()),
+            'changed': len(changed),
+            'removed': int(removed.sum()),
+            'added': int(added.sum()),
+            'column_mismatches': column_mismatches,
+            'duplicate_rows_1': duplicates_1,
+            'duplicate_rows_2': duplicates_2,
+        },
+    }
+
+
+# Cap on differing rows kept by comparisons that work piece by piece, summary counts are always complete
+MAX_DIFF_ROWS = 100000
+
+
+def _aligned_row_hashes(df1, df2, columns_1, columns_2, rules=None):
+    # Keyless comparisons match whole rows by hash, so only the normalizing rules apply, not tolerances
+    values_1, values_2 = {}, {}
+    for position, (column_1, column_2) in enumerate(zip(columns_1, columns_2)):
+        rule = compare_rule(rules, column_1)
+        values_1[position], values_2[position] = _align_compare_dtypes(_normalize_compare_values(df1[column_1], rule),
+                                                                       _normalize_compare_values(df2[column_2], rule))
+    return _row_hashes(pd.DataFrame(values_1)), _row_hashes(pd.DataFrame(values_2))
+
+
+def multiset_diff(df1, df2, columns_1, columns_2, max_rows=MAX_DIFF_ROWS, rules=None):
+    # Keyless comparison that keeps duplicate counts: rows are hashed, counted per distinct value on each
+    # side, and every value whose count differs is reported with both counts.
+    columns_1, columns_2 = list(columns_1), list(columns_2)
+    hashes_1, hashes_2 = _aligned_row_hashes(df1, df2, columns_1, columns_2, rules)
+    unique_1, first_1, counts_1 = np.unique(hashes_1, return_index=True, return_counts=True)
+    unique_2, first_2, counts_2 = np.unique(hashes_2, return_index=True, return_counts=True)
+    counts = pd.DataFrame({'count_1': pd.Series(counts_1, index=unique_1),
+                           'count_2': pd.Series(counts_2, index=unique_2)}).fillna(0).astype('int64')
+    counts['first_1'] = pd.Series(first_1, index=unique_1)
+    counts['first_2'] = pd.Series(first_2, index=unique_2)
+    extra_1 = counts[counts['count_1'] > counts['count_2']].head(max_rows)
+    extra_2 = counts[counts['count_2'] > counts['count_1']].head(max_rows)
+    removed = df1[columns_1].iloc[extra_1['first_1'].astype('int64')].reset_index(drop=True)
+    removed[['count_1', 'count_2']] = extra_1[['count_1', 'count_2']].to_numpy()
+    added = df2[columns_2].iloc[extra_2['first_2'].astype('int64')].reset_index(drop=True)
+    added[['count_1', 'count_2']] = extra_2[['count_1', 'count_2']].to_numpy()
+    surplus = counts['count_1'] - counts['count_2']
+    return {
+        'keys': [],
+        'columns_1': columns_1,
+        'columns_2': columns_2,
+        'changed': pd.DataFrame(),
+        'removed': removed,
+        'added': added,
+        'summary': {
+            'rows_1': len(df1),
+            'rows_2': len(df2),
+            'matched': int(np.minimum(counts['count_1'], counts['count_2']).sum()),
+            'changed': 0,
+            'removed': int(surplus.clip(lower=0).sum()),
+            'added': int((-surplus).clip(lower=0).sum()),
+            'column_mismatches': {},
+        },
+    }
+
+
+def _increasing_anchors(values):
+    # Mask of anchors whose positions increase on both sides, fully vectorized. Anchors under the running
+    # maximum from the left, or above the running minimum from the right, are dropped; the pass keeping
+    # more anchors wins. A single row moved either way costs one delete and one insert, but several
+    # crossing moves can give a longer script than a true longest increasing subsequence would.
+    if not len(values):
+        return np.array([], dtype=bool)
+    forward = values >= np.maximum.accumulate(values)
+    backward = values <= np.minimum.accumulate(values[::-1])[::-1]
+    return forward if forward.sum() >= backward.sum() else backward
+
+
+def ordered_diff(df1, df2, columns_1, columns_2, max_rows=MAX_DIFF_ROWS, rules=None):
+    # Edit script between positionally aligned results. The n-th copy of a row on one side anchors to the
+    # n-th copy on the other; anchors keeping both positions increasing (see _increasing_anchors) become
+    # 'equal' runs and the gaps between them 'delete' / 'insert' / 'replace' ops (difflib-style i1, i2, j1,
+    # j2 ranges).
+    columns_1, columns_2 = list(columns_1), list(columns_2)
+    hashes_1, hashes_2 = _aligned_row_hashes(df1, df2, columns_1, columns_2, rules)
+    occurrence_1 = pd.Series(hashes_1).groupby(hashes_1).cumcount().to_numpy()
+    occurrence_2 = pd.Series(hashes_2).groupby(hashes_2).cumcount().to_numpy()
+    tokens_1 = pd.util.hash_pandas_object(pd.DataFrame({'h': hashes_1, 'o': occurrence_1}), index=False).to_numpy()
+    tokens_2 = pd.util.hash_pandas_object(pd.DataFrame({'h': hashes_2, 'o': occurrence_2}), index=False).to_numpy()
+    _, anchors_1, anchors_2 = np.intersect1d(tokens_1, tokens_2, assume_unique=True, return_indices=True)
+    order = np.argsort(anchors_1)
+    anchors_1, anchors_2 = anchors_1[order], anchors_2[order]
+    monotone = _increasing_anchors(anchors_2)
+    anchors_1, anchors_2 = anchors_1[monotone], anchors_2[monotone]
+
+    # Touching anchors form 'equal' runs; whatever lies between two runs is an edit
+    breaks = np.r_[True, (np.diff(anchors_1) != 1) | (np.diff(anchors_2) != 1)][:len(anchors_1)]
+    starts = np.flatnonzero(breaks)
+    ends = np.append(starts[1:], len(anchors_1))[:len(starts)] - 1
+    equal = pd.DataFrame({'tag': 'equal', 'i1': anchors_1[starts], 'i2': anchors_1[ends] + 1,
+                          'j1': anchors_2[starts], 'j2': anchors_2[ends] + 1})
+    gaps = pd.DataFrame({'i1': np.r_[0, equal['i2']], 'i2': np.r_[equal['i1'], len(df1)],
+                         'j1': np.r_[0, equal['j2']], 'j2': np.r_[equal['j1'], len(df2)]})
+    gaps.insert(0, 'tag', np.select([(gaps['i2'] > gaps['i1']) & (gaps['j2'] > gaps['j1']), gaps['i2'] > gaps['i1'],
+                                     gaps['j2'] > gaps['j1']], ['replace', 'delete', 'insert'], default=''))
+    ops = pd.concat([gaps[gaps['tag'] != ''], equal], ignore_index=True).sort_values(['i1', 'j1', 'i2'],
+                                                                                      kind='stable')
+
+    edits = ops[ops['tag'] != 'equal'].reset_index(drop=True)
+    removed_mask = np.zeros(len(df1), dtype=bool)
+    added_mask = np.zeros(len(df2), dtype=bool)
+    # Expand the (start, end) ranges to row masks without looping over rows
+    for mask, starts, ends in ((removed_mask, edits['i1'], edits['i2']), (added_mask, edits['j1'], edits['j2'])):
+        steps = np.zeros(len(mask) + 1, dtype='int64')
+        np.add.at(steps, starts.to_numpy(), 1)
+        np.add.at(steps, ends.to_numpy(), -1)
+        mask |= np.cumsum(steps)[:-1] > 0
+    removed = df1[columns_1][removed_mask].head(max_rows)
+    added = df2[columns_2][added_mask].head(max_rows)
+    return {
+        'keys': [],
+        'columns_1': columns_1,
+        'columns_2': columns_2,
+        'changed': pd.DataFrame(),
+        'removed': removed.rename_axis('row_1').reset_index(),
+        'added': added.rename_axis('row_2').reset_index(),
+        'edit_script': edits[['tag', 'i1', 'i2', 'j1', 'j2']],
+        'summary': {
+            'rows_1': len(df1),
+            'rows_2': len(df2),
+            'matched': int(len(df1) - removed_mask.sum()),
+            'changed': 0,
+            'removed': int(removed_mask.sum()),
+            'added': int(added_mask.sum()),
+            'column_mismatches': {},
+        },
+    }
+
+
+def quote_identifier(conn_config, name):
+    # Quotes a column name the way the connection's dialect expects (Snowflake keeps lowercase names unquoted)
+    return get_sqlalchemy_engine(conn_config).dialect.identifier_preparer.quote(name)
+
+
+def build_pushdown_diff_sql(sql_1, sql_2, quote, keys_1, keys_2, columns_1, columns_2, occurrence=False):
+    # Returns (rows_sql, summary_sql). With keys: FULL OUTER JOIN on the key with one mismatch flag per
+    # column pair. Without keys: EXCEPT in both directions over the compared columns.
+    # occurrence=True pairs duplicate keys by their rank within the key instead of joining every pair.
+    if not keys_1:
+        select_1 = ", ".join(f"q1.{quote(column)}" for column in columns_1)
+        select_2 = ", ".join(f"q2.{quote(column)}" for column in columns_2)
+        only_1 = f"SELECT {select_1} FROM ({sql_1}) AS q1 EXCEPT SELECT {select_2} FROM ({sql_2}) AS q2"
+        only_2 = f"SELECT {select_2} FROM ({sql_2}) AS q2 EXCEPT SELECT {select_1} FROM ({sql_1}) AS q1"
+        rows_sql = (only_1, only_2)
+        summary_sql = (f"SELECT (SELECT COUNT(*) FROM ({sql_1}) AS q1) AS rows_1, "
+                       f"(SELECT COUNT(*) FROM ({sql_2}) AS q2) AS rows_2, "
+                       f"(SELECT COUNT(*) FROM ({only_1}) AS d1) AS removed, "
+                       f"(SELECT COUNT(*) FROM ({only_2}) AS d2) AS added")
+        return rows_sql, summary_sql
+
+    both = "q1.diff_present IS NOT NULL AND q2.diff_present IS NOT NULL"
+    join = " AND ".join(f"q1.{quote(key_1)} = q2.{quote(key_2)}" for key_1, key_2 in zip(keys_1, keys_2))
+    marker_1 = marker_2 = "1 AS diff_present"
+    if occurrence:
+        join += " AND q1.diff_occurrence = q2.diff_occurrence"
+        for side, keys, columns in ((1, keys_1, columns_1), (2, keys_2, columns_2)):
+            rank = (f"ROW_NUMBER() OVER (PARTITION BY {', '.join(f'q.{quote(key)}' for key in keys)} "
+                    f"ORDER BY {', '.join(f'q.{quote(column)}' for column in list(columns) or list(keys))}) "
+                    f"AS diff_occurrence")
+            if side == 1:
+                marker_1 = f"{marker_1}, {rank}"
+            else:
+                marker_2 = f"{marker_2}, {rank}"
+    selects = [f"COALESCE(q1.{quote(key_1)}, q2.{quote(key_2)}) AS {quote(key_1)}"
+               for key_1, key_2 in zip(keys_1, keys_2)]
+    flags = []
+    for position, (column_1, column_2) in enumerate(zip(columns_1, columns_2)):
+        selects.append(f"q1.{quote(column_1)} AS {quote(column_1 + DIFF_SUFFIX_1)}")
+        selects.append(f"q2.{quote(column_2)} AS {quote(column_2 + DIFF_SUFFIX_2)}")
+        flags.append(f"CASE WHEN {both} AND q1.{quote(column_1)} IS DISTINCT FROM q2.{quote(column_2)} "
+                     f"THEN 1 ELSE 0 END AS diff_flag_{position}")
+    any_flag = " OR ".join(f"q1.{quote(column_1)} IS DISTINCT FROM q2.{quote(column_2)}"
+                           for column_1, column_2 in zip(columns_1, columns_2)) or "1 = 0"
+    status = (f"CASE WHEN q1.diff_present IS NULL THEN 'added' WHEN q2.diff_present IS NULL THEN 'removed' "
+              f"WHEN {any_flag} THEN 'changed' ELSE 'same' END AS diff_status")
+    diff = (f"SELECT {', '.join(selects + flags + [status])} "
+            f"FROM (SELECT q.*, {marker_1} FROM ({sql_1}) AS q) AS q1 "
+            f"FULL OUTER JOIN (SELECT q.*, {marker_2} FROM ({sql_2}) AS q) AS q2 ON {join}")
+    rows_sql = f"SELECT * FROM ({diff}) AS d WHERE diff_status <> 'same'"
+    flag_sums = "".join(f", SUM(diff_flag_{position}) AS diff_flag_{position}" for position in range(len(flags)))
+    summary_sql = (f"SELECT SUM(CASE WHEN diff_status <> 'added' THEN 1 ELSE 0 END) AS rows_1, "
+                   f"SUM(CASE WHEN diff_status <> 'removed' THEN 1 ELSE 0 END) AS rows_2, "
+                   f"SUM(CASE WHEN diff_status IN ('same', 'changed') THEN 1 ELSE 0 END) AS matched, "
+                   f"SUM(CASE WHEN diff_status = 'changed' THEN 1 ELSE 0 END) AS changed, "
+                   f"SUM(CASE WHEN diff_status = 'removed' THEN 1 ELSE 0 END) AS removed, "
+                   f"SUM(CASE WHEN diff_status = 'added' THEN 1 ELSE 0 END) AS added"
+                   f"{flag_sums} FROM ({diff}) AS d")
+    return rows_sql, summary_sql
+
+
+def pushdown_diff(query_config_1, query_config_2, conn_config, keys_1, keys_2, columns_1, columns_2,
+                  max_rows=MAX_DIFF_ROWS, occurrence=False):
+    # Compares two queries on the same connection inside the warehouse and only fetches the
+    # differing rows plus summary counts. Returns the same structure as hash_diff.
+    rows_sql, summary_sql = build_pushdown_diff_sql(
+        build_query_sql(query_config_1), build_query_sql(query_config_2),
+        lambda name: quote_identifier(conn_config, name), keys_1, keys_2, columns_1, columns_2, occurrence)
+    summary_row = fetch_data(summary_sql, conn_config).iloc[0]
+    counts = {name: int(value) if pd.notna(value) else 0 for name, value in summary_row.items()}
+    summary = {
+        'rows_1': counts['rows_1'],
+        'rows_2': counts['rows_2'],
+        'matched': counts.get('matched'),
+        'changed': counts.get('changed', 0),
+        'removed': counts['removed'],
+        'added': counts['added'],
+        'column_mismatches': {column_1: counts[f'diff_flag_{position}']
+                              for position, column_1 in enumerate(columns_1) if keys_1},
+    }
+    if not keys_1:
+        removed = fetch_data(rows_sql[0], conn_config, max_rows, fetch_mode='arrow')
+        added = fetch_data(rows_sql[1], conn_config, max_rows, fetch_mode='arrow')
+        return {'keys': [], 'columns_1': list(columns_1), 'columns_2': list(columns_2),
+                'changed': pd.DataFrame(), 'removed': removed, 'added': added, 'summary': summary}
+
+    rows = fetch_data(rows_sql, conn_config, max_rows, fetch_mode='arrow')
+    value_columns = []
+    for column_1, column_2 in zip(columns_1, columns_2):
+        value_columns += [f'{column_1}{DIFF_SUFFIX_1}', f'{column_2}{DIFF_SUFFIX_2}']
+    return {
+        'keys': list(keys_1),
+        'columns_1': list(columns_1),
+        'columns_2': list(columns_2),
+        'changed': rows.loc[rows['diff_status'] == 'changed', list(keys_1) + value_columns].reset_index(drop=True),
+        'removed': rows.loc[rows['diff_status'] == 'removed', list(keys_1)].reset_index(drop=True),
+        'added': rows.loc[rows['diff_status'] == 'added', list(keys_1)].reset_index(drop=True),
+        'summary': summary,
+    }
+
+
+# Per-dialect SQL for bucketed checksum comparisons. Buckets are integer key ranges of equal width.
+CHECKSUM_DIALECTS = {
+    'snowflake': {'bucket': "FLOOR(({key} - {low}) / {width})", 'checksum': "HASH_AGG({columns})"},
+    'duckdb': {'bucket': "({key} - {low}) // {width}", 'checksum': "SUM(HASH({columns}))"},
+    'sqlite': {'bucket': "({key} - {low}) / {width}", 'checksum': "hash_agg({columns})"},
+}
+CHECKSUM_FANOUT = 64
+# Buckets holding at most this many rows on either side are fetched and diffed instead of subdivided
+CHECKSUM_LEAF_ROWS = 2000
+# Ranges per statement when fetching leaf rows
+CHECKSUM_FETCH_RANGES = 100
+
+
+def _checksum_dialect(conn_config):
+    name = get_sqlalchemy_engine(conn_config).dialect.name
+    if name not in CHECKSUM_DIALECTS:
+        raise ValueError(f"Checksum comparison is not supported for {name} connections.")
+    return name
+
+
+def _fetch_bucket_checksums(sql, conn_config, key, columns, ranges):
+    # One round trip per level: every pending range is bucketed in its own UNION ALL branch
+    dialect = CHECKSUM_DIALECTS[_checksum_dialect(conn_config)]
+    quoted_key = quote_identifier(conn_config, key)
+    quoted_columns = ", ".join(quote_identifier(conn_config, column) for column in [key] + list(columns))
+    selects = []
+    for range_id, (low, high, width) in enumerate(ranges):
+        bucket = dialect['bucket'].format(key=quoted_key, low=low, width=width)
+        selects.append(f"SELECT {range_id} AS range_id, {bucket} AS bucket, COUNT(*) AS row_count, "
+                       f"{dialect['checksum'].format(columns=quoted_columns)} AS checksum FROM ({sql}) AS q "
+                       f"WHERE {quoted_key} >= {low} AND {quoted_key} < {high} GROUP BY {bucket}")
+    buckets = {}
+    engine = get_sqlalchemy_engine(conn_config)
+    with engine.connect() as connection:
+        for range_id, bucket, row_count, checksum in connection.execute(text(" UNION ALL ".join(selects))):
+            buckets[(int(range_id), int(bucket))] = (int(row_count), str(checksum))
+    return buckets
+
+
+def _fetch_key_ranges(sql, conn_config, key, columns, ranges):
+    quoted_key = quote_identifier(conn_config, key)
+    projection = ", ".join(quote_identifier(conn_config, column) for column in [key] + list(columns))
+    frames = []
+    for start in range(0, len(ranges), CHECKSUM_FETCH_RANGES):
+        predicate = " OR ".join(f"({quoted_key} >= {low} AND {quoted_key} < {high})"
+                                for low, high in ranges[start:start + CHECKSUM_FETCH_RANGES])
+        frames.append(fetch_data(f"SELECT {projection} FROM ({sql}) AS q WHERE {predicate}", conn_config,
+                                 fetch_mode='arrow'))
+    return pd.concat(frames, ignore_index=True)
+
+
+def checksum_diff(query_config_1, conn_config_1, query_config_2, conn_config_2, key_1, key_2, columns_1, columns_2,
+                  fanout=CHECKSUM_FANOUT, leaf_rows=CHECKSUM_LEAF_ROWS, rules=None):
+    # Merkle-style comparison for queries on different connections of the same dialect: compare row counts
+    # and hash checksums over integer key-range buckets, subdivide only mismatched buckets, then fetch and
+    # hash_diff the rows of the small leaf ranges. Rows with a NULL key are not covered. Bucket checksums are
+    # exact, so rules only take effect on the fetched leaves.
+    if _checksum_dialect(conn_config_1) != _checksum_dialect(conn_config_2):
+        raise ValueError("Checksum comparison needs both connections to use the same database type.")
+    sql_1, sql_2 = build_query_sql(query_config_1), build_query_sql(query_config_2)
+
+    bounds = []
+    for sql, conn_config, key in ((sql_1, conn_config_1, key_1), (sql_2, conn_config_2, key_2)):
+        quoted_key = quote_identifier(conn_config, key)
+        bounds.append(fetch_data(f"SELECT MIN({quoted_key}) AS low, MAX({quoted_key}) AS high, COUNT(*) AS row_count "
+                                 f"FROM ({sql}) AS q", conn_config).iloc[0])
+    rows_1, rows_2 = int(bounds[0]['row_count']), int(bounds[1]['row_count'])
+    lows = [bound['low'] for bound in bounds if pd.notna(bound['low'])]
+    highs = [bound['high'] for bound in bounds if pd.notna(bound['high'])]
+    if lows and any(float(value) != int(value) for value in lows + highs):
+        raise ValueError("Checksum comparison needs an integer key column.")
+
+    leaves, matched, checksum_queries = [], 0, 2
+    pending = []
+    if lows:
+        low, high = int(min(lows)), int(max(highs)) + 1
+        pending = [(low, high, max(1, -(-(high - low) // fanout)))]
+    while pending:
+        buckets_1 = _fetch_bucket_checksums(sql_1, conn_config_1, key_1, columns_1, pending)
+        buckets_2 = _fetch_bucket_checksums(sql_2, conn_config_2, key_2, columns_2, pending)
+        checksum_queries += 2
+        next_pending = []
+        for bucket_id in sorted(set(buckets_1) | set(buckets_2)):
+            side_1, side_2 = buckets_1.get(bucket_id), buckets_2.get(bucket_id)
+            if side_1 == side_2:
+                matched += side_1[0]
+                continue
+            range_id, bucket = bucket_id
+            range_low, range_high, width = pending[range_id]
+            low = range_low + bucket * width
+            high = min(low + width, range_high)
+            largest = max((side or (0, None))[0] for side in (side_1, side_2))
+            if largest <= leaf_rows or width == 1:
+                leaves.append((low, high))
+            else:
+                next_pending.append((low, high, max(1, -(-(high - low) // fanout))))
+        pending = next_pending
+
+    if leaves:
+        leaf_df_1 = _fetch_key_ranges(sql_1, conn_config_1, key_1, columns_1, leaves)
+        leaf_df_2 = _fetch_key_ranges(sql_2, conn_config_2, key_2, columns_2, leaves)
+        result = hash_diff(leaf_df_1, leaf_df_2, [key_1], [key_2], columns_1, columns_2, rules)
+        fetched_rows = len(leaf_df_1) + len(leaf_df_2)
+    else:
+        result = hash_diff(pd.DataFrame(columns=[key_1] + list(columns_1)),
+                           pd.DataFrame(columns=[key_2] + list(columns_2)), [key_1], [key_2], columns_1, columns_2,
+                           rules)
+        fetched_rows = 0
+    result['summary'].update({
+        'rows_1': rows_1,
+        'rows_2': rows_2,
+        'matched': matched + result['summary']['matched'],
+        'fetched_rows': fetched_rows,
+        'checksum_queries': checksum_queries,
+    })
+    return result
+
+
+# Semi-join key reduction for queries on different connections: the smaller side is fetched in full and only
+# its keys are shipped to the larger side, as batched IN-lists (single key) or a temporary table
+SEMI_JOIN_IN_LIST = "IN-lists"
+SEMI_JOIN_TEMP_TABLE = "Temporary table"
+SEMI_JOIN_METHODS = (SEMI_JOIN_TEMP_TABLE, SEMI_JOIN_IN_LIST)
+# Every IN-list statement rescans the larger query, so IN-lists are only used when all keys fit in one;
+# more keys switch to the temporary table
+SEMI_JOIN_IN_LIST_MAX_KEYS = 1000
+SEMI_JOIN_INSERT_ROWS = 10000
+
+
+def _rows_to_frame(rows, names):
+    return pa.Table.from_batches([_rows_to_record_batch(rows, names)]).to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _fetch_rows_in_list(sql, conn_config, key, columns, key_values, max_rows=MAX_DIFF_ROWS):
+    # Same results as _fetch_rows_temp_table for a single key column, with the key values bound as one IN-list
+    # (at most SEMI_JOIN_IN_LIST_MAX_KEYS of them). NULL keys count as unmatched, as with NOT EXISTS.
+    quoted_key = quote_identifier(conn_config, key)
+    projection = ", ".join(quote_identifier(conn_config, column) for column in dict.fromkeys([key] + list(columns)))
+    unmatched_filter = f"{quoted_key} IS NULL OR {quoted_key} NOT IN :keys"
+    statements = [
+        text(f"SELECT {projection} FROM ({sql}) AS q WHERE {quoted_key} IN :keys"),
+        text(f"SELECT {quoted_key} FROM ({sql}) AS q WHERE {unmatched_filter} LIMIT {int(max_rows)}"),
+        text(f"SELECT COUNT(*) FROM ({sql}) AS q WHERE {unmatched_filter}"),
+    ]
+    statements = [statement.bindparams(bindparam('keys', expanding=True)) for statement in statements]
+    with get_sqlalchemy_engine(conn_config).connect() as connection:
+        result = connection.execute(statements[0], {'keys': key_values})
+        matched = _rows_to_frame([tuple(row) for row in result], list(result.keys()))
+        result = connection.execute(statements[1], {'keys': key_values})
+        unmatched = _rows_to_frame([tuple(row) for row in result], list(result.keys()))
+        unmatched_count = connection.execute(statements[2], {'keys': key_values}).scalar()
+    return matched, unmatched, int(unmatched_count)
+
+
+def _semi_join_column_type(series):
+    if pd.api.types.is_bool_dtype(series):
+        return sa_types.Boolean()
+    if pd.api.types.is_integer_dtype(series):
+        return sa_types.BigInteger()
+    if pd.api.types.is_float_dtype(series):
+        return sa_types.Float()
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return sa_types.DateTime()
+    return sa_types.String()
+
+
+def _fetch_rows_temp_table(sql, conn_config, keys, columns, key_frame, max_rows=MAX_DIFF_ROWS):
+    # Loads the keys into a session temporary table (keyed, so every EXISTS probe is an index lookup where the
+    # database indexes primary keys), then fetches the rows with a matching key and (up to
+    # max_rows of) the keys without one. Returns (matched rows, unmatched keys, unmatched row count).
+    quoted_keys = [quote_identifier(conn_config, key) for key in keys]
+    table = Table(f"compare_keys_{uuid.uuid4().hex[:12]}", MetaData(),
+                  *[Column(f"k{position}", _semi_join_column_type(key_frame[key]), primary_key=True,
+                           autoincrement=False)
+                    for position, key in enumerate(keys)], prefixes=['TEMPORARY'])
+    match = " AND ".join(f"t.k{position} = q.{quoted}" for position, quoted in enumerate(quoted_keys))
+    exists = f"EXISTS (SELECT 1 FROM {quote_identifier(conn_config, table.name)} AS t WHERE {match})"
+    projection = ", ".join(f"q.{quote_identifier(conn_config, column)}"
+                           for column in dict.fromkeys(list(keys) + list(columns)))
+    key_projection = ", ".join(f"q.{quoted}" for quoted in quoted_keys)
+    records = pa.Table.from_pandas(key_frame, preserve_index=False).to_pylist()
+    with get_sqlalchemy_engine(conn_config).connect() as connection:
+        table.create(connection)
+        try:
+            for start in range(0, len(records), SEMI_JOIN_INSERT_ROWS):
+                batch = records[start:start + SEMI_JOIN_INSERT_ROWS]
+                connection.execute(table.insert(), [{f"k{position}": record[key] for position, key in enumerate(keys)}
+                                                    for record in batch])
+            result = connection.execute(text(f"SELECT {projection} FROM ({sql}) AS q WHERE {exists}"))
+            matched = _rows_to_frame([tuple(row) for row in result], list(result.keys()))
+            result = connection.execute(text(f"SELECT {key_projection} FROM ({sql}) AS q WHERE NOT {exists} "
+                                             f"LIMIT {int(max_rows)}"))
+            unmatched = _rows_to_frame([tuple(row) for row in result], list(result.keys()))
+            unmatched_count = connection.execute(
+                text(f"SELECT COUNT(*) FROM ({sql}) AS q WHERE NOT {exists}")).scalar()
+        finally:
+            table.drop(connection)
+            connection.commit()
+    return matched, unmatched, int(unmatched_count)
+
+
+def semi_join_diff(query_config_1, conn_config_1, query_config_2, conn_config_2, keys_1, keys_2, columns_1,
+                   columns_2, method=SEMI_JOIN_TEMP_TABLE, rules=None, max_rows=MAX_DIFF_ROWS):
+    # hash_diff of the smaller side against only those rows of the larger side whose key it has. Keys that
+    # exist only on the larger side are counted in the warehouse and reported like any other added/removed
+    # keys.
+    keys_1, keys_2 = list(keys_1), list(keys_2)
+    if not keys_1 or len(keys_1) != len(keys_2):
+        raise ValueError("Semi-join comparison needs the same number of key columns (at least one) on each side.")
+    sides = [
+        {'query': query_config_1, 'conn': conn_config_1, 'keys': keys_1, 'columns': list(columns_1)},
+        {'query': query_config_2, 'conn': conn_config_2, 'keys': keys_2, 'columns': list(columns_2)},
+    ]
+    for side in sides:
+        side['rows'] = int(execute_query(side['query'], side['conn'], count_only=True, use_cache=False) or 0)
+    small, large = (sides[0], sides[1]) if sides[0]['rows'] <= sides[1]['rows'] else (sides[1], sides[0])
+
+    small_df = execute_query(small['query'], small['conn'], full_fetch=True, fetch_mode='arrow', use_cache=False,
+                             columns=small['keys'] + small['columns'])
+    key_frame = small_df[small['keys']].dropna().drop_duplicates()
+    key_frame.columns = large['keys']
+    large_sql = build_query_sql(large['query'])
+    if method == SEMI_JOIN_IN_LIST and (len(keys_1) > 1 or len(key_frame) > SEMI_JOIN_IN_LIST_MAX_KEYS):
+        # Composite keys do not fit a portable IN-list, and several IN-lists would each rescan the larger side
+        method = SEMI_JOIN_TEMP_TABLE
+    if method == SEMI_JOIN_IN_LIST:
+        large_df, unmatched, unmatched_count = _fetch_rows_in_list(large_sql, large['conn'], large['keys'][0],
+                                                                   large['columns'], key_frame.iloc[:, 0].tolist(),
+                                                                   max_rows)
+    else:
+        large_df, unmatched, unmatched_count = _fetch_rows_temp_table(large_sql, large['conn'], large['keys'],
+                                                                      large['columns'], key_frame, max_rows)
+    fetched_rows = len(small_df) + len(large_df) + len(unmatched)
+
+    if small is sides[0]:
+        result = hash_diff(small_df, large_df, keys_1, keys_2, columns_1, columns_2, rules)
+        unmatched.columns = keys_2
+        result['added'], result['summary']['added'] = unmatched, unmatched_count
+    else:
+        result = hash_diff(large_df, small_df, keys_1, keys_2, columns_1, columns_2, rules)
+        unmatched.columns = keys_1
+        result['removed'], result['summary']['removed'] = unmatched, unmatched_count
+    result['summary'].update({
+        'rows_1': sides[0]['rows'],
+        'rows_2': sides[1]['rows'],
+        'fetched_rows': fetched_rows,
+        'semi_join_method': method,
+    })
+    return result
+
+
+# Column profile pre-check: aggregates computed in the warehouse decide which columns need a row-level compare
+PROFILE_DISTINCT = {
+    'snowflake': "APPROX_COUNT_DISTINCT({column})",
+    'duckdb': "APPROX_COUNT_DISTINCT({column})",
+}
+# Sums are compared with at least this relative tolerance, float addition order differs between runs
+PROFILE_SUM_REL_TOLERANCE = 1e-9
+
+
+def build_profile_sql(sql, conn_config, columns, numeric_columns=(), row_columns=None, key_columns=()):
+    # A single row: COUNT(*) and a whole-row checksum, then per column the NULL count, MIN, MAX, SUM (numeric
+    # columns only), distinct count and a checksum. Returns the SQL and the (column, stat) of each output.
+    # The checksum of a non-key column covers key_columns too, so values moving between keys change it.
+    dialect_name = get_sqlalchemy_engine(conn_config).dialect.name
+    checksum = CHECKSUM_DIALECTS.get(dialect_name, {}).get('checksum')
+    distinct = PROFILE_DISTINCT.get(dialect_name, "COUNT(DISTINCT {column})")
+    expressions, outputs = ["COUNT(*)"], [(None, 'row_count')]
+    if checksum and row_columns:
+        quoted_row = ", ".join(quote_identifier(conn_config, column) for column in row_columns)
+        expressions.append(checksum.format(columns=quoted_row))
+        outputs.append((None, 'checksum'))
+    for column in columns:
+        quoted = quote_identifier(conn_config, column)
+        stats = [('nulls', f"COUNT(*) - COUNT({quoted})"), ('min', f"MIN({quoted})"), ('max', f"MAX({quoted})")]
+        if column in numeric_columns:
+            stats.append(('sum', f"SUM({quoted})"))
+        stats.append(('distinct', distinct.format(column=quoted)))
+        if checksum:
+            paired = [quote_identifier(conn_config, key) for key in key_columns if key != column] + [quoted]
+            stats.append(('checksum', checksum.format(columns=", ".join(paired))))
+        for stat, expression in stats:
+            expressions.append(expression)
+            outputs.append((column, stat))
+    return f"SELECT {', '.join(expressions)} FROM ({sql}) AS q", outputs
+
+
+def fetch_column_profiles(query_config, conn_config, columns, numeric_columns=(), row_columns=None,
+                          key_columns=()):
+    # {column: {stat: value}}, with the whole-row stats under None
+    sql, outputs = build_profile_sql(build_query_sql(query_config), conn_config, columns, numeric_columns,
+                                     row_columns, key_columns)
+    with get_sqlalchemy_engine(conn_config).connect() as connection:
+        values = connection.execute(text(sql)).fetchone()
+    profiles = {}
+    for (column, stat), value in zip(outputs, values):
+        profiles.setdefault(column, {})[stat] = value
+    return profiles
+
+
+def _profile_values_equal(value_1, value_2, stat, rule):
+    if value_1 is None or value_2 is None:
+        return value_1 is None and value_2 is None
+    if stat in ('min', 'max', 'sum') and isinstance(value_1, numbers.Number) \
+            and isinstance(value_2, numbers.Number):
+        value_1, value_2 = float(value_1), float(value_2)
+        rel_tolerance = rule['rel_tolerance']
+        if stat == 'sum':
+            rel_tolerance = max(rel_tolerance, PROFILE_SUM_REL_TOLERANCE)
+        allowed = rule['abs_tolerance'] + rel_tolerance * max(abs(value_1), abs(value_2))
+        return value_1 == value_2 or abs(value_1 - value_2) <= allowed
+    try:
+        return bool(value_1 == value_2)
+    except TypeError:
+        return str(value_1) == str(value_2)
+
+
+def compare_column_profiles(profiles_1, profiles_2, columns_1, columns_2, same_dialect=True, rules=None):
+    # Mismatching stats per column pair. Distinct estimates and checksums are only comparable when both
+    # sides were computed by the same database type.
+    skipped = set() if same_dialect else {'distinct', 'checksum'}
+    mismatches = []
+    for column_1, column_2 in zip(columns_1, columns_2):
+        rule = compare_rule(rules, column_1)
+        stats_1, stats_2 = profiles_1.get(column_1, {}), profiles_2.get(column_2, {})
+        for stat in stats_1:
+            if stat in skipped or stat not in stats_2:
+                continue
+            if not _profile_values_equal(stats_1[stat], stats_2[stat], stat, rule):
+                mismatches.append({'column_1': column_1, 'column_2': column_2, 'stat': stat,
+                                   'value_1': str(stats_1[stat]), 'value_2': str(stats_2[stat])})
+    return pd.DataFrame(mismatches, columns=['column_1', 'column_2', 'stat', 'value_1', 'value_2'])
+
+
+def profile_precheck(query_config_1, conn_config_1, query_config_2, conn_config_2, keys_1, keys_2, columns_1,
+                     columns_2, numeric_columns_1=(), numeric_columns_2=(), rules=None):
+    # Returns (identical, column pairs still to compare row by row, mismatching stats). identical is only
+    # claimed when the whole-row checksums agree as well, equal column profiles alone do not prove that rows
+    # pair up the same way. Columns are only dropped from the row-level compare when their key-paired
+    # checksums are comparable; without keys or checksums every column is still compared.
+    row_columns_1, row_columns_2 = list(keys_1) + list(columns_1), list(keys_2) + list(columns_2)
+    profiles_1 = fetch_column_profiles(query_config_1, conn_config_1, row_columns_1, numeric_columns_1,
+                                       row_columns_1, keys_1)
+    profiles_2 = fetch_column_profiles(query_config_2, conn_config_2, row_columns_2, numeric_columns_2,
+                                       row_columns_2, keys_2)
+    same_dialect = (get_sqlalchemy_engine(conn_config_1).dialect.name ==
+                    get_sqlalchemy_engine(conn_config_2).dialect.name)
+    mismatches = compare_column_profiles(profiles_1, profiles_2, row_columns_1, row_columns_2, same_dialect, rules)
+    rows_1, rows_2 = profiles_1[None], profiles_2[None]
+    rows_equal = (same_dialect and 'checksum' in rows_1 and rows_1['row_count'] == rows_2['row_count']
+                  and str(rows_1['checksum']) == str(rows_2['checksum']))
+    if rows_equal and mismatches.empty:
+        return True, [], mismatches
+    differing = set(mismatches['column_1'])
+    pairs = [(column_1, column_2) for column_1, column_2 in zip(columns_1, columns_2) if column_1 in differing]
+    if not keys_1 or not same_dialect or 'checksum' not in rows_1:
+        # Nothing tracks how values pair up into rows, so no column can be ruled out
+        pairs = list(zip(columns_1, columns_2))
+    if not pairs or differing & set(keys_1):
+        # Keys differ, or only the way values pair up into rows: every column needs the row-level compare
+        pairs = list(zip(columns_1, columns_2))
+    return False, pairs, mismatches
+
+
+# Out-of-core comparison: each partition pair should fit in this budget, hash_diff needs about SPILL_OVERHEAD
+# times the raw size of its inputs
+SPILL_MEMORY_BUDGET_BYTES = 512 * 2 ** 20
+SPILL_OVERHEAD = 4
+SPILL_DEFAULT_PARTITIONS = 64
+
+
+def _canonical_keys(frame, keys):
+    # Equal keys must land in the same partition on both sides whatever their dtypes
+    canonical = {}
+    for key in keys:
+        column = frame[key]
+        canonical[key] = column.astype('float64') if pd.api.types.is_numeric_dtype(column) else column.astype('string')
+    return pd.DataFrame(canonical)
+
+
+def _key_partitions(frame, keys, partitions):
+    return (pd.util.hash_pandas_object(_canonical_keys(frame, keys), index=False).to_numpy() % partitions).astype(
+        'int64')
+
+
+def spill_partitions(chunks, keys, columns, partitions, directory, prefix):
+    # Hash-partitions a stream of DataFrames by key into one Arrow IPC file per partition.
+    # Returns the list of file paths (None for partitions that received no rows).
+    paths = [None] * partitions
+    writers = {}
+    schema = None
+    try:
+        for chunk in chunks:
+            chunk = chunk[list(keys) + list(columns)]
+            partition_ids = _key_partitions(chunk, keys, partitions)
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if schema is None:
+                schema = table.schema
+            elif table.schema != schema:
+                table = table.cast(schema)
+            for partition in np.unique(partition_ids):
+                if partition not in writers:
+                    paths[partition] = os.path.join(directory, f"{prefix}_{partition}.arrow")
+                    writers[partition] = pa.ipc.new_file(paths[partition], schema)
+                writers[partition].write_table(table.filter(pa.array(partition_ids == partition)))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return paths, schema
+
+
+def _read_partition(path, schema, columns):
+    if path is None and schema is None:
+        # That side returned no rows at all
+        return pd.DataFrame({column: pd.Series(dtype='object') for column in columns})
+    if path is None:
+        return schema.empty_table().to_pandas(types_mapper=pd.ArrowDtype)
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def merge_diff_results(results, keys, columns_1, columns_2, max_rows=MAX_DIFF_ROWS):
+    # Combines diffs of disjoint partitions into one diff, keeping at most max_rows rows per frame
+    summary = {'rows_1': 0, 'rows_2': 0, 'matched': 0, 'changed': 0, 'removed': 0, 'added': 0,
+               'column_mismatches': {column: 0 for column in columns_1}}
+    frames = {'changed': [], 'removed': [], 'added': []}
+    kept = {'changed': 0, 'removed': 0, 'added': 0}
+    for result in results:
+        for name in ('rows_1', 'rows_2', 'matched', 'changed', 'removed', 'added'):
+            summary[name] += result['summary'][name]
+        for column, count in result['summary']['column_mismatches'].items():
+            summary['column_mismatches'][column] += count
+        for name in frames:
+            if kept[name] < max_rows and len(result[name]):
+                frames[name].append(result[name].head(max_rows - kept[name]))
+                kept[name] += len(frames[name][-1])
+    merged = {'keys': list(keys), 'columns_1': list(columns_1), 'columns_2': list(columns_2), 'summary': summary}
+    for name, parts in frames.items():
+        merged[name] = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=list(keys))
+    return merged
+
+
+def _estimate_partitions(first_chunk_1, first_chunk_2, expected_rows, memory_budget):
+    if not expected_rows:
+        return SPILL_DEFAULT_PARTITIONS
+    expected_bytes = 0
+    for chunk, rows in zip((first_chunk_1, first_chunk_2), expected_rows):
+        if chunk is not None and len(chunk):
+            expected_bytes += rows * chunk.memory_usage(deep=True).sum() / len(chunk)
+    return max(1, math.ceil(expected_bytes * SPILL_OVERHEAD / memory_budget))
+
+
+def diff_partition_files(path_1, schema_1, path_2, schema_2, keys_1, keys_2, columns_1, columns_2, rules=None):
+    # Diffs one spilled partition pair; also the unit of work for the process pool
+    partition_1 = _read_partition(path_1, schema_1, list(keys_1) + list(columns_1))
+    partition_2 = _read_partition(path_2, schema_2, list(keys_2) + list(columns_2))
+    return hash_diff(partition_1, partition_2, keys_1, keys_2, columns_1, columns_2, rules)
+
+
+def _module_function(name):
+    # Streamlit executes this file as __main__, which worker processes cannot unpickle functions from,
+    # so hand them the function from the module imported under its own name
+    module = importlib.import_module(os.path.splitext(os.path.basename(__file__))[0])
+    return getattr(module, name)
+
+
+def _diff_partition_pairs(paths_1, schema_1, paths_2, schema_2, keys_1, keys_2, columns_1, columns_2, workers=1,
+                          rules=None):
+    pairs = [(path_1, path_2) for path_1, path_2 in zip(paths_1, paths_2) if path_1 or path_2]
+    arguments = (keys_1, keys_2, columns_1, columns_2, rules)
+    if workers <= 1 or len(pairs) <= 1:
+        return [diff_partition_files(path_1, schema_1, path_2, schema_2, *arguments) for path_1, path_2 in pairs]
+    # Workers memory-map the Arrow IPC files themselves, only file paths and the small diffs get pickled.
+    # spawn rather than fork: the Streamlit server process runs many threads.
+    worker = _module_function('diff_partition_files')
+    with ProcessPoolExecutor(max_workers=min(workers, len(pairs)),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(worker, path_1, schema_1, path_2, schema_2, *arguments)
+                   for path_1, path_2 in pairs]
+        return [future.result() for future in futures]
+
+
+def out_of_core_diff(chunks_1, chunks_2, keys_1, keys_2, columns_1, columns_2, expected_rows=None,
+                     memory_budget=SPILL_MEMORY_BUDGET_BYTES, partitions=None, spill_dir=None, workers=1, rules=None):
+    # Streams both sides into key-hash partitions on disk and diffs one partition pair at a time, so memory
+    # is bounded by the budget rather than the result size. expected_rows=(rows_1, rows_2) sizes the partitions.
+    # With workers > 1 that many partition pairs are diffed at once, each within the budget.
+    chunks_1, chunks_2 = iter(chunks_1), iter(chunks_2)
+    first_1, first_2 = next(chunks_1, None), next(chunks_2, None)
+    if partitions is None:
+        partitions = _estimate_partitions(first_1, first_2, expected_rows, memory_budget)
+    chunks_1 = itertools.chain([first_1] if first_1 is not None else [], chunks_1)
+    chunks_2 = itertools.chain([first_2] if first_2 is not None else [], chunks_2)
+
+    with tempfile.TemporaryDirectory(prefix='compare_spill_', dir=spill_dir) as directory:
+        paths_1, schema_1 = spill_partitions(chunks_1, keys_1, columns_1, partitions, directory, 'left')
+        paths_2, schema_2 = spill_partitions(chunks_2, keys_2, columns_2, partitions, directory, 'right')
+        results = _diff_partition_pairs(paths_1, schema_1, paths_2, schema_2, keys_1, keys_2, columns_1, columns_2,
+                                        workers, rules)
+    merged = merge_diff_results(results, keys_1, columns_1, columns_2)
+    merged['summary']['partitions'] = partitions
+    return merged
+
+
+# Process-parallel comparison of in-memory results, opt-in from the dashboard. Spawning the pool and spilling
+# to IPC files costs more than a serial hash_diff of a million rows (4.4 s vs 0.8 s on one CPU), so inputs
+# below PARALLEL_MIN_ROWS always run serially even when workers are asked for.
+PARALLEL_MAX_WORKERS = 8
+PARALLEL_MIN_ROWS = 1000000
+
+
+def parallel_hash_diff(df1, df2, keys_1, keys_2, columns_1, columns_2, workers=1, partitions=None, rules=None):
+    # hash_diff split by key-hash partition across a process pool. Partitions are handed to the workers as
+    # Arrow IPC files so the DataFrames themselves are never pickled.
+    workers = min(int(workers or 1), PARALLEL_MAX_WORKERS, os.cpu_count() or 1)
+    if workers <= 1 or max(len(df1), len(df2)) < PARALLEL_MIN_ROWS:
+        return hash_diff(df1, df2, keys_1, keys_2, columns_1, columns_2, rules)
+    partitions = partitions or workers * 2
+    with tempfile.TemporaryDirectory(prefix='compare_parallel_') as directory:
+        paths_1, schema_1 = spill_partitions([df1], keys_1, columns_1, partitions, directory, 'left')
+        paths_2, schema_2 = spill_partitions([df2], keys_2, columns_2, partitions, directory, 'right')
+        results = _diff_partition_pairs(paths_1, schema_1, paths_2, schema_2, keys_1, keys_2, columns_1, columns_2,
+                                        workers, rules)
+    merged = merge_diff_results(results, keys_1, columns_1, columns_2, max_rows=max(len(df1), len(df2)))
+    merged['summary']['partitions'] = partitions
+    return merged
+
+
+def render_diff_result(result, name_1, name_2):
+    summary = result['summary']
+    st.subheader("Comparison Results")
+    if result['keys']:
+        st.write(f"Matched keys: {summary['matched']} | Changed rows: {summary['changed']} | "
+                 f"Only in {name_1}: {summary['removed']} | Only in {name_2}: {summary['added']}")
+    else:
+        st.write(f"Rows only in {name_1}: {summary['removed']} | Rows only in {name_2}: {summary['added']}")
+    if not summary['changed'] and not summary['removed'] and not summary['added']:
+        st.write("No differences found in the selected columns.")
+        return
+    if summary['column_mismatches']:
+        st.write("Mismatches per column:", summary['column_mismatches'])
+    if summary['changed']:
+        labels = {}
+        for column_1, column_2 in zip(result['columns_1'], result['columns_2']):
+            labels[f'{column_1}{DIFF_SUFFIX_1}'] = f"{name_1} ({column_1})"
+            labels[f'{column_2}{DIFF_SUFFIX_2}'] = f"{name_2} ({column_2})"
+        st.write(result['changed'].rename(columns=labels))
+    label = "Keys" if result['keys'] else "Rows"
+    if summary['removed']:
+        st.write(f"{label} only in {name_1}:")
+        st.write(result['removed'])
+    if summary['added']:
+        st.write(f"{label} only in {name_2}:")
+        st.write(result['added'])
+
+
+# Column matching: each column is reduced to a small fingerprint so pairings are found without comparing every
+# column of one query with every column of the other
+COLUMN_MATCH_MAX_ROWS = 200000
+COLUMN_MATCH_SAMPLE_ROWS = 50000
+MINHASH_BINS = 64
+MINHASH_BAND_BINS = 4
+KMV_SIZE = 256
+COLUMN_MATCH_MIN_SCORE = 0.35
+# Numeric and datetime columns also meet in buckets of their rounded profile (min and max to two significant
+# digits, null ratio in steps of 0.05), so values that differ only by rounding are still paired
+PROFILE_BUCKET_DIGITS = 2
+PROFILE_BUCKET_NULL_STEP = 0.05
+COLUMN_MATCH_QUANTILES = np.linspace(0, 1, 11)
+COLUMN_MATCH_QUANTILE_ROWS = 10000
+_EMPTY_BIN = np.iinfo(np.uint64).max
+
+
+def _column_kind(series):
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        return 'numeric'
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return 'datetime'
+    return 'string'
+
+
+def _fingerprint_values(series, kind):
+    # Same value, same representation on both sides: numbers as float64, timestamps as UTC microseconds
+    values = series.dropna()
+    if kind == 'numeric':
+        return values.astype('float64').to_numpy()
+    if kind == 'datetime':
+        stamps = pd.to_datetime(values, utc=True)
+        return ((stamps - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(microseconds=1)).to_numpy(dtype='int64')
+    return values.astype('string').str.strip().to_numpy(dtype=object)
+
+
+def column_fingerprint(series, max_rows=COLUMN_MATCH_MAX_ROWS):
+    series = series.iloc[:max_rows]
+    kind = _column_kind(series)
+    values = _fingerprint_values(series, kind)
+    fingerprint = {'kind': kind, 'dtype': str(series.dtype), 'rows': len(series),
+                   'null_ratio': 1 - len(values) / len(series) if len(series) else 0.0,
+                   'min': None, 'max': None, 'quantiles': None}
+    if len(values) and kind != 'string':
+        fingerprint['min'], fingerprint['max'] = float(values.min()), float(values.max())
+        # Every n-th value is plenty for a handful of quantiles
+        step = max(1, len(values) // COLUMN_MATCH_QUANTILE_ROWS)
+        fingerprint['quantiles'] = np.quantile(values[::step].astype('float64'), COLUMN_MATCH_QUANTILES)
+    hashes = pd.unique(pd.util.hash_array(values)) if len(values) else np.empty(0, dtype=np.uint64)
+    # K minimum values: the k-th smallest hash tells how densely the hash space is filled
+    if len(hashes) > KMV_SIZE:
+        kmv = np.sort(np.partition(hashes, KMV_SIZE - 1)[:KMV_SIZE])
+        fingerprint['distinct'] = int((KMV_SIZE - 1) / (float(kmv[-1]) / 2.0 ** 64))
+    else:
+        kmv = np.sort(hashes)
+        fingerprint['distinct'] = len(hashes)
+    fingerprint['kmv'] = kmv
+    # One-permutation MinHash: the low bits pick a bin, the smallest remaining bits per bin form the signature
+    signature = np.full(MINHASH_BINS, _EMPTY_BIN, dtype=np.uint64)
+    np.minimum.at(signature, (hashes % np.uint64(MINHASH_BINS)).astype(np.intp), hashes // np.uint64(MINHASH_BINS))
+    fingerprint['minhash'] = signature
+    return fingerprint
+
+
+def column_fingerprints(df, max_rows=COLUMN_MATCH_MAX_ROWS):
+    return {column: column_fingerprint(df[column], max_rows) for column in df.columns}
+
+
+def minhash_similarity(fingerprint_1, fingerprint_2):
+    signature_1, signature_2 = fingerprint_1['minhash'], fingerprint_2['minhash']
+    used = (signature_1 != _EMPTY_BIN) | (signature_2 != _EMPTY_BIN)
+    if not used.any():
+        return 0.0
+    return float((signature_1[used] == signature_2[used]).mean())
+
+
+def _normalized_column_name(name):
+    return re.sub(r'[^0-9a-z]', '', str(name).lower())
+
+
+def _range_similarity(fingerprint_1, fingerprint_2):
+    if fingerprint_1['min'] is None or fingerprint_2['min'] is None:
+        return 0.0
+    low, high = max(fingerprint_1['min'], fingerprint_2['min']), min(fingerprint_1['max'], fingerprint_2['max'])
+    span = max(fingerprint_1['max'], fingerprint_2['max']) - min(fingerprint_1['min'], fingerprint_2['min'])
+    if span == 0:
+        return 1.0
+    return max(high - low, 0.0) / span
+
+
+def _quantile_similarity(fingerprint_1, fingerprint_2):
+    # 1 when the value distributions line up, falling with the mean quantile distance relative to the span
+    if fingerprint_1['quantiles'] is None or fingerprint_2['quantiles'] is None:
+        return 0.0
+    span = max(fingerprint_1['max'], fingerprint_2['max']) - min(fingerprint_1['min'], fingerprint_2['min'])
+    distance = float(np.abs(fingerprint_1['quantiles'] - fingerprint_2['quantiles']).mean())
+    if span == 0:
+        return float(distance == 0)
+    return max(0.0, 1 - distance / span)
+
+
+def column_match_score(name_1, fingerprint_1, name_2, fingerprint_2):
+    # Returns (score, value overlap). Numeric and datetime values that differ only slightly (rounding,
+    # precision) share no hashes, their matching distributions stand in for the overlap.
+    if fingerprint_1['kind'] != fingerprint_2['kind']:
+        return 0.0, 0.0
+    jaccard = minhash_similarity(fingerprint_1, fingerprint_2)
+    overlap = max(jaccard, _quantile_similarity(fingerprint_1, fingerprint_2))
+    name_score = float(_normalized_column_name(name_1) == _normalized_column_name(name_2))
+    nulls = 1 - abs(fingerprint_1['null_ratio'] - fingerprint_2['null_ratio'])
+    distinct = (min(fingerprint_1['distinct'], fingerprint_2['distinct']) /
+                max(fingerprint_1['distinct'], fingerprint_2['distinct'], 1))
+    # Strings have no meaningful range, so the value overlap counts twice instead
+    ranges = jaccard if fingerprint_1['kind'] == 'string' else _range_similarity(fingerprint_1, fingerprint_2)
+    return 0.5 * overlap + 0.2 * name_score + 0.1 * nulls + 0.1 * distinct + 0.1 * ranges, jaccard
+
+
+def _quantize(value, offset, digits=PROFILE_BUCKET_DIGITS):
+    # Rounds to a few significant digits; offset 0.5 shifts the grid by half a step
+    if value == 0:
+        return 0
+    exponent = math.floor(math.log10(abs(value))) - digits + 1
+    return exponent, math.floor(value / 10.0 ** exponent + offset)
+
+
+def _profile_buckets(fingerprint):
+    # Two shifted grids, so two close values that straddle a step of one grid still meet on the other
+    if fingerprint['min'] is None:
+        return []
+    return [('profile', fingerprint['kind'], _quantize(fingerprint['min'], offset),
+             _quantize(fingerprint['max'], offset),
+             math.floor(fingerprint['null_ratio'] / PROFILE_BUCKET_NULL_STEP + offset))
+            for offset in (0.0, 0.5)]
+
+
+def _candidate_pairs(fingerprints_1, fingerprints_2):
+    # LSH banding: columns sharing any band of their signature, the same normalized name or the same rounded
+    # profile become candidates
+    buckets = {}
+    for side, fingerprints in enumerate((fingerprints_1, fingerprints_2)):
+        for column, fingerprint in fingerprints.items():
+            names = [('name', _normalized_column_name(column))] + _profile_buckets(fingerprint)
+            signature = fingerprint['minhash']
+            for start in range(0, MINHASH_BINS, MINHASH_BAND_BINS):
+                band = signature[start:start + MINHASH_BAND_BINS]
+                if (band != _EMPTY_BIN).any():
+                    names.append((start, band.tobytes()))
+            for bucket in names:
+                buckets.setdefault(bucket, ([], []))[side].append(column)
+    candidates = set()
+    for columns_1, columns_2 in buckets.values():
+        candidates.update(itertools.product(columns_1, columns_2))
+    return candidates
+
+
+def match_columns(df1, df2, min_score=COLUMN_MATCH_MIN_SCORE, exclude_1=(), exclude_2=()):
+    fingerprints_1 = column_fingerprints(df1.drop(columns=list(exclude_1)))
+    fingerprints_2 = column_fingerprints(df2.drop(columns=list(exclude_2)))
+    scored = []
+    for column_1, column_2 in _candidate_pairs(fingerprints_1, fingerprints_2):
+        score, jaccard = column_match_score(column_1, fingerprints_1[column_1], column_2, fingerprints_2[column_2])
+        if score >= min_score:
+            scored.append((score, jaccard, column_1, column_2))
+    # Greedy one-to-one assignment, best pair first
+    matched_1, matched_2, pairs = set(), set(), []
+    for score, jaccard, column_1, column_2 in sorted(scored, key=lambda pair: pair[:2], reverse=True):
+        if column_1 not in matched_1 and column_2 not in matched_2:
+            matched_1.add(column_1)
+            matched_2.add(column_2)
+            pairs.append({'column_1': column_1, 'column_2': column_2, 'score': round(score, 3),
+                          'value_overlap': round(jaccard, 3)})
+    order = {column: position for position, column in enumerate(df1.columns)}
+    pairs.sort(key=lambda pair: order[pair['column_1']])
+    return pd.DataFrame(pairs, columns=['column_1', 'column_2', 'score', 'value_overlap'])
+
+
+def fetch_match_sample(query_config, connections, sample_size=COLUMN_MATCH_SAMPLE_ROWS):
+    # Larger than the preview sample so the fingerprints see enough values to overlap
+    conn_config = get_query_connection(query_config, connections)
+    if not conn_config:
+        return None
+    return fetch_data(build_query_sql(query_config), conn_config, sample_size, fetch_mode='arrow')
+
+
+# Comparison strategies offered in the Comparison Dashboard
+COMPARE_IN_MEMORY = "In memory"
+COMPARE_PUSHDOWN = "Warehouse pushdown"
+COMPARE_CHECKSUM = "Bucketed checksums"
+COMPARE_OUT_OF_CORE = "Out of core (spill to disk)"
+COMPARE_SEMI_JOIN = "Key semi-join (fetch overlapping rows)"
 
 
 def main():
@@ -176,6 +2597,19 @@ def main():
     with tab1:
         st.header("Dashboard")
 
+        cache_stats = get_result_cache_stats()
+        st.caption(f"Result cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                   f"{cache_stats['entries']} entries ({cache_stats['megabytes']} MB)")
+        if st.button("Clear Result Cache"):
+            invalidate_result_cache()
+
+        with st.expander("Snapshot Store"):
+            snapshots = list_snapshots()
+            st.write(f"{len(snapshots)} snapshots, {round(snapshots['bytes'].sum() / 2 ** 20, 2)} MB in {SNAPSHOT_DIR}")
+            if st.button("Apply Snapshot Retention"):
+                removed = gc_snapshots()
+                st.success(f"Removed {len(removed)} snapshots.")
+
         groups = {}
         for query in st.session_state['queries']:
             group_name = query['group']
@@ -183,17 +2617,75 @@ def main():
                 groups[group_name] = []
             groups[group_name].append(query)
 
+        # All row counts for the dashboard in one round trip per connection
+        all_queries = [query for group_queries in groups.values() for query in group_queries]
+        batch_counts, batch_errors = fetch_batch_counts(all_queries, st.session_state['connections'])
+        row_counts = {id(query): (count, error) for query, count, error in zip(all_queries, batch_counts, batch_errors)}
+
         for group_name, group_queries in groups.items():
             st.subheader(f"Group: {group_name}")
             if st.button(f"Refresh Group: {group_name}"):
-                for query in group_queries:
-                    query['result'] = run_query(query, st.session_state['connections'])
+                # Queries whose freshness can be told are only re-run when their tables changed
+                group_freshness = batch_query_freshness(group_queries, st.session_state['connections'])
+                for query, freshness in zip(group_queries, group_freshness):
+                    if freshness is None:
+                        invalidate_result_cache(query_config=query)
+                progress = st.progress(0.0, text=f"Refreshing {len(group_queries)} queries...")
+
+                def report_progress(done, total, query, error):
+                    status = "failed" if error else "done"
+                    progress.progress(done / total, text=f"{done}/{total} - {query['name']} {status}")
+
+                results, errors = refresh_queries_parallel(group_queries, st.session_state['connections'],
+                                                           on_progress=report_progress)
+                for query, result in zip(group_queries, results):
+                    query['result'] = result if result is None or not result.empty else None
+                if errors:
+                    st.error(f"{len(errors)} of {len(group_queries)} queries failed to refresh:")
+                    for query, message in errors:
+                        st.write(f"- **{query['name']}**: {message}")
+                else:
+                    st.success(f"Refreshed {len(group_queries)} queries.")
+
+            # Full results only go to the snapshot store, from a worker thread; the page stays usable meanwhile
+            # Jobs are per session, every session has its own "Default Group"
+            refresh_job = f"{session_id()}:group:{group_name}"
+            if st.button(f"Refresh in Background: {group_name}"):
+                if not start_background_refresh(refresh_job, group_queries, st.session_state['connections']):
+                    st.warning("A background refresh of this group is still running.")
+            refresh_status = get_background_refresh(refresh_job)
+            if refresh_status and not refresh_status['finished_at']:
+                @st.fragment(run_every=2)
+                def refresh_progress():
+                    render_background_refresh(refresh_job)
+                    job = get_background_refresh(refresh_job)
+                    if job and job['finished_at']:
+                        st.rerun()
+
+                refresh_progress()
+            else:
+                render_background_refresh(refresh_job)
 
             for i, query in enumerate(group_queries):
                 st.markdown(f"**{query['name']}** - Tag: {query.get('tag', 'None')}")
 
-                # Get and display total row count
-                row_count = run_query(query, st.session_state['connections'],count_only=True)
+                # Latest stored result, read from disk only when asked for
+                snapshot_conn = next((conn for conn in st.session_state['connections']
+                                      if conn['id'] == query.get('connection_id')), None)
+                snapshot_path = latest_snapshot(query, snapshot_conn) if snapshot_conn else None
+                if snapshot_path:
+                    info = snapshot_info(snapshot_path)
+                    st.caption(f"Latest snapshot: {info['created_at']} ({info['rows']} rows)")
+                    if st.checkbox(f"Show Latest Snapshot for {query['name']}",
+                                   key=f"show_snapshot_{i}_{query['name']}"):
+                        if info['rows'] > SNAPSHOT_PREVIEW_ROWS:
+                            st.caption(f"First {SNAPSHOT_PREVIEW_ROWS} of {info['rows']} rows.")
+                        st.dataframe(preview_snapshot(snapshot_path))
+
+                # Display total row count from the batched counts
+                row_count, count_error = row_counts[id(query)]
+                if count_error:
+                    st.error(f"Test failed: {count_error}")
                 st.write(f"Available Rows: {row_count}")
 
                 # Checkbox to show sample data
@@ -206,22 +2698,69 @@ def main():
                     if sample_df is not None:
                         st.dataframe(sample_df)
 
+                    # Only the chosen columns are fetched for the exports; none chosen exports all of them
+                    export_columns = []
+                    export_schema = get_query_schema(query, st.session_state['connections'])
+                    if export_schema is not None:
+                        export_columns = st.multiselect(f"Columns to export from {query['name']}",
+                                                        options=export_schema['column'].tolist(),
+                                                        key=f"export_columns_{i}_{query['name']}")
+
                     # Button to export full data to Excel
                     if st.button(f"Export Full Data for {query['name']}", key=f"export_{i}_{query['name']}"):
-                        full_df = run_query(query, st.session_state['connections'], full_fetch=True)
-                        if full_df is not None:
-                            towrite = io.BytesIO()
-                            with pd.ExcelWriter(towrite, engine='xlsxwriter') as writer:
-                                full_df.to_excel(writer, index=False, sheet_name='Sheet1')
-                            towrite.seek(0)
-                            st.download_button(
-                                label="Download Excel",
-                                data=towrite,
-                                file_name=f"{query['name']}_full.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                            )
-                        else:
-                            st.warning("No data available to export.")
+                        export_path = None
+                        try:
+                            # Stream chunks straight into a spooled workbook so memory stays flat
+                            export_path, rows_written = export_excel_stream(
+                                run_query_stream(query, st.session_state['connections'], columns=export_columns))
+                            if rows_written:
+                                # Only writing is streamed: Streamlit reads the whole file into its in-memory
+                                # media store to serve the download, so large exports still cost their size
+                                with open(export_path, 'rb') as export_file:
+                                    st.download_button(
+                                        label="Download Excel",
+                                        data=export_file,
+                                        file_name=f"{query['name']}_full.xlsx",
+                                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                                    )
+                            else:
+                                st.warning("No data available to export.")
+                        except Exception as e:
+                            st.error(f"Export failed: {e}")
+                        finally:
+                            if export_path and os.path.exists(export_path):
+                                os.remove(export_path)
+
+                    # Columnar formats are written straight from the Arrow batches
+                    format_columns = st.columns(len(COLUMNAR_EXPORT_FORMATS))
+                    for column, export_format in zip(format_columns, COLUMNAR_EXPORT_FORMATS):
+                        with column:
+                            if not st.button(f"Export {export_format}",
+                                             key=f"export_{export_format}_{i}_{query['name']}"):
+                                continue
+                            _, _, extension, mime = COLUMNAR_EXPORT_FORMATS[export_format]
+                            export_path = None
+                            try:
+                                export_path, rows_written = export_columnar_stream(
+                                    run_query_batches(query, st.session_state['connections'],
+                                                      columns=export_columns), export_format)
+                                if rows_written:
+                                    # Served from Streamlit's in-memory media store, like the Excel export
+                                    with open(export_path, 'rb') as export_file:
+                                        st.download_button(
+                                            label=f"Download {export_format}",
+                                            data=export_file,
+                                            file_name=f"{query['name']}_full{extension}",
+                                            mime=mime,
+                                            key=f"download_{export_format}_{i}_{query['name']}"
+                                        )
+                                else:
+                                    st.warning("No data available to export.")
+                            except Exception as e:
+                                st.error(f"Export failed: {e}")
+                            finally:
+                                if export_path and os.path.exists(export_path):
+                                    os.remove(export_path)
 
     with tab2:
         st.header("Configuration")
@@ -234,6 +2773,7 @@ def main():
         if st.button("Add New Query"):
             st.session_state['queries'].append({
                 'group': st.session_state['groups'][0],  # Default to first group
+                'id': uuid.uuid4().hex[:12],
                 'name': f"Query {len(st.session_state['queries']) + 1}",
                 'base_sql': "SELECT * FROM table",
                 'filter': "",
@@ -267,6 +2807,25 @@ def main():
                     key=f"conn_select_{i}"
                 )
 
+                # Incremental refresh: only rows past the watermark of the latest snapshot are fetched
+                query['watermark_column'] = st.text_input(
+                    f"Watermark Column for Query {i + 1} (OPTIONAL, e.g. updated_at)",
+                    value=query.get('watermark_column', ''), key=f"watermark_{i}")
+                merge_keys = st.text_input(
+                    f"Merge Key Columns for Query {i + 1} (OPTIONAL, comma separated; empty appends)",
+                    value=", ".join(query.get('merge_keys') or []), key=f"merge_keys_{i}")
+                query['merge_keys'] = [key.strip() for key in merge_keys.split(',') if key.strip()]
+
+                # Freshness checks: cached counts and results are reused while the query's tables are unchanged
+                query['check_freshness'] = st.checkbox(
+                    f"Skip re-running Query {i + 1} while its tables are unchanged",
+                    value=query.get('check_freshness', False), key=f"check_freshness_{i}")
+                if query['check_freshness']:
+                    query['freshness_sql'] = st.text_input(
+                        f"Freshness Probe SQL for Query {i + 1} (OPTIONAL, required for local databases, "
+                        f"e.g. SELECT MAX(updated_at), COUNT(*) FROM orders)",
+                        value=query.get('freshness_sql', ''), key=f"freshness_sql_{i}")
+
 
                 if st.button(f"Test Query {i + 1}", key=f"test_{i}"):
                     try:
@@ -279,18 +2838,38 @@ def main():
                         st.error(f"Test failed: {e}")
                         print(f"Test failed: {e}")
 
+                if st.button(f"Benchmark Fetch Modes {i + 1}", key=f"benchmark_{i}"):
+                    conn_config = next((conn for conn in st.session_state['connections']
+                                        if conn['id'] == query['connection_id']), None)
+                    if conn_config:
+                        sql = query['base_sql']
+                        if query.get('filter'):
+                            sql += f" WHERE {query['filter']}"
+                        try:
+                            st.dataframe(benchmark_fetch_modes(sql, conn_config))
+                        except Exception as e:
+                            st.error(f"Benchmark failed: {e}")
+                    else:
+                        st.error("Selected connection configuration not found.")
+
                 if st.button(f"Remove Query {i + 1}", key=f"remove_{i}"):
                     st.session_state['queries'].pop(i)
 
         if st.button("Export Queries"):
             export_data = [
                 {
+                    'id': query_id(q),
                     'group': q['group'],
                     'name': q['name'],
                     'base_sql': q['base_sql'],
                     'filter': q['filter'],
                     'connection_id': q['connection_id'],
-                    'tag': q['tag']
+                    'tag': q['tag'],
+                    'compare_rules': q.get('compare_rules', {}),
+                    'watermark_column': q.get('watermark_column', ''),
+                    'merge_keys': q.get('merge_keys', []),
+                    'check_freshness': q.get('check_freshness', False),
+                    'freshness_sql': q.get('freshness_sql', '')
                 }
                 for q in st.session_state['queries']
             ]
@@ -341,10 +2920,29 @@ def main():
                 conn['password'] = st.text_input(f"Password {i + 1}", type="password", value=conn.get('password', ''),
                                                  key=f"password_{i}")
                 conn['account'] = st.text_input(f"Account {i + 1}", value=conn['account'], key=f"account_{i}")
-                conn['url'] = st.text_input(f"URL {i + 1} (OPTIONAL)", value=conn.get('url', ''), key=f"url_{i}")
+                # A full SQLAlchemy URL may carry user:password@, so it is masked like the password
+                conn['url'] = st.text_input(f"URL {i + 1} (OPTIONAL)", type="password", value=conn.get('url', ''),
+                                            key=f"url_{i}")
                 conn['warehouse'] = st.text_input(f"Warehouse {i + 1}", value=conn['warehouse'], key=f"warehouse_{i}")
                 conn['database'] = st.text_input(f"Database {i + 1}", value=conn['database'], key=f"database_{i}")
                 conn['schema'] = st.text_input(f"Schema {i + 1}", value=conn['schema'], key=f"schema_{i}")
+                conn['pool_size'] = st.number_input(f"Pool Size {i + 1}", min_value=1, max_value=50,
+                                                    value=int(conn.get('pool_size', DEFAULT_POOL_SIZE)),
+                                                    key=f"pool_size_{i}")
+                conn['pool_recycle'] = st.number_input(f"Pool Recycle Seconds {i + 1}", min_value=60,
+                                                       value=int(conn.get('pool_recycle', DEFAULT_POOL_RECYCLE)),
+                                                       key=f"pool_recycle_{i}")
+                conn['max_concurrency'] = st.number_input(f"Max Concurrent Queries {i + 1}", min_value=1,
+                                                          max_value=64,
+                                                          value=int(conn.get('max_concurrency',
+                                                                             DEFAULT_MAX_CONCURRENCY)),
+                                                          key=f"max_concurrency_{i}")
+                conn['pool_pre_ping'] = st.checkbox(f"Pre-Ping Pooled Connections {i + 1}",
+                                                    value=conn.get('pool_pre_ping', DEFAULT_POOL_PRE_PING),
+                                                    key=f"pool_pre_ping_{i}")
+
+                # Drop the pooled engine as soon as the connection is edited
+                claim_engine((session_id(), conn['id']), conn)
 
                 if st.button(f"Test Connection {i + 1}", key=f"test_conn_{i}"):
                     success, message = test_snowflake_connection(conn)
@@ -356,12 +2954,19 @@ def main():
                         st.spinner()
 
                 if st.button(f"Remove Connection {i + 1}", key=f"remove_conn_{i}"):
+                    invalidate_engine((session_id(), conn['id']), conn)
                     st.session_state['connections'].pop(i)
                     st.spinner()
 
+        with st.expander("Connection Pool Statistics"):
+            pool_stats = get_pool_stats()
+            if pool_stats:
+                st.dataframe(pd.DataFrame(pool_stats))
+            else:
+                st.write("No pooled engines yet.")
+
         if st.button("Export Snowflake Configurations"):
-            export_connections = [{key: conn[key] for key in conn if key not in ('user', 'password')} for conn in
-                                  st.session_state['connections']]
+            export_connections = [export_connection_config(conn) for conn in st.session_state['connections']]
             connections_json = json.dumps(export_connections, indent=2)
             st.download_button(
                 label="Download Configurations",
@@ -396,74 +3001,262 @@ def main():
             query2 = next((q for q in st.session_state["queries"] if q["name"] == comparison_queries[1]), None)
 
             if query1 and query2:
-                df1 = run_query(query1, st.session_state["connections"],full_fetch=True,count_only=False)
-                df2 = run_query(query2, st.session_state["connections"],full_fetch=True,count_only=False)
-
-                if df1 is not None and df2 is not None:
-                    # Reset index to ensure it starts from 0, providing a row index
-                    df1.reset_index(drop=True, inplace=True)
-                    df2.reset_index(drop=True, inplace=True)
+                # Same connection: the comparison can run in the warehouse. Different connections: bucket
+                # checksums narrow it down first. The selectors only need the column names.
+                if query1.get('connection_id') and query1.get('connection_id') == query2.get('connection_id'):
+                    comparison_modes = [COMPARE_PUSHDOWN, COMPARE_IN_MEMORY]
+                else:
+                    comparison_modes = [COMPARE_IN_MEMORY, COMPARE_CHECKSUM, COMPARE_SEMI_JOIN]
+                comparison_modes.append(COMPARE_OUT_OF_CORE)
+                comparison_mode = st.selectbox("Comparison Mode", options=comparison_modes)
+                if comparison_mode == COMPARE_SEMI_JOIN:
+                    semi_join_method = st.selectbox("Ship keys to the larger side as", options=SEMI_JOIN_METHODS)
+                if comparison_mode == COMPARE_OUT_OF_CORE:
+                    memory_budget_mb = st.number_input("Memory budget per partition (MB)", min_value=16,
+                                                       value=SPILL_MEMORY_BUDGET_BYTES // 2 ** 20)
+                    spill_workers = st.number_input("Partitions compared in parallel", min_value=1,
+                                                    max_value=PARALLEL_MAX_WORKERS, value=1)
+                in_memory = comparison_mode == COMPARE_IN_MEMORY
+
+                schema_1 = get_query_schema(query1, st.session_state["connections"])
+                schema_2 = get_query_schema(query2, st.session_state["connections"])
+
+                if schema_1 is not None and schema_2 is not None:
+                    columns_1, columns_2 = schema_1['column'].tolist(), schema_2['column'].tolist()
 
                     # Display column names for verification
-                    st.write(f"Columns in {query1['name']}:", df1.columns.tolist())
-                    st.write(f"Columns in {query2['name']}:", df2.columns.tolist())
+                    with st.expander("Columns"):
+                        st.write(f"Columns in {query1['name']}:", schema_1)
+                        st.write(f"Columns in {query2['name']}:", schema_2)
 
                     # Option to use or not use primary keys
                     use_primary_key = st.checkbox("Use Primary Key for Alignment", value=True)
-
+                    ordered_rows = False
+                    if not use_primary_key and in_memory:
+                        ordered_rows = st.checkbox("Rows are in matching order (show an edit script)", value=False)
+                    compare_workers = 1
+                    if use_primary_key and in_memory:
+                        compare_workers = st.number_input(
+                            "Worker processes for the in-memory compare", min_value=1, max_value=PARALLEL_MAX_WORKERS,
+                            value=1, help=f"Only used from {PARALLEL_MIN_ROWS:,} rows on, and only pays off on "
+                                          f"multi-core machines with several million rows.")
+
+                    compare_options_1, compare_options_2 = list(columns_1), list(columns_2)
                     if use_primary_key:
-                        primary_key_1 = st.selectbox(f"Select primary key column from {query1['name']}",
-                                                     options=df1.columns)
-                        primary_key_2 = st.selectbox(f"Select primary key column from {query2['name']}",
-                                                     options=df2.columns)
-
-                        df1.set_index(primary_key_1, inplace=True)
-                        df2.set_index(primary_key_2, inplace=True)
-
-                    selected_column_1 = st.selectbox(f"Select a column from {query1['name']} to compare",
-                                                     options=df1.columns)
-                    selected_column_2 = st.selectbox(f"Select a column from {query2['name']} to compare",
-                                                     options=df2.columns)
+                        # Composite keys are paired by position, like the compared columns
+                        primary_keys_1 = st.multiselect(f"Select primary key columns from {query1['name']}",
+                                                        options=columns_1, default=columns_1[:1])
+                        primary_keys_2 = st.multiselect(f"Select primary key columns from {query2['name']}",
+                                                        options=columns_2, default=columns_2[:1])
+                        compare_options_1 = [column for column in compare_options_1 if column not in primary_keys_1]
+                        compare_options_2 = [column for column in compare_options_2 if column not in primary_keys_2]
+                    else:
+                        primary_keys_1, primary_keys_2 = [], []
+
+                    match_key = f"column_matches_{query1['name']}_{query2['name']}"
+                    if st.button("Suggest Column Pairs"):
+                        with st.spinner("Fingerprinting columns..."):
+                            match_df1 = fetch_match_sample(query1, st.session_state["connections"])
+                            match_df2 = fetch_match_sample(query2, st.session_state["connections"])
+                            if match_df1 is not None and match_df2 is not None:
+                                st.session_state[match_key] = match_columns(match_df1, match_df2,
+                                                                            exclude_1=primary_keys_1,
+                                                                            exclude_2=primary_keys_2)
+                    suggested_pairs = st.session_state.get(match_key)
+                    default_columns_1, default_columns_2 = [], []
+                    if suggested_pairs is not None:
+                        st.write("Suggested column pairs:", suggested_pairs)
+                        for column_1, column_2 in suggested_pairs[['column_1', 'column_2']].itertuples(index=False):
+                            if column_1 in compare_options_1 and column_2 in compare_options_2:
+                                default_columns_1.append(column_1)
+                                default_columns_2.append(column_2)
+
+                    # Columns are paired by position: the first selected in each query, the second, ...
+                    selected_columns_1 = st.multiselect(f"Select columns from {query1['name']} to compare",
+                                                        options=compare_options_1, default=default_columns_1)
+                    selected_columns_2 = st.multiselect(f"Select columns from {query2['name']} to compare",
+                                                        options=compare_options_2, default=default_columns_2)
+
+                    # Rules live with the first query, keyed by its column, and are exported with it
+                    compare_rules = query1.setdefault('compare_rules', {})
+                    if selected_columns_1:
+                        with st.expander("Comparison Rules"):
+                            for column in selected_columns_1:
+                                rule = compare_rule(compare_rules, column)
+                                st.markdown(f"**{column}**")
+                                rule_columns = st.columns(6)
+                                rule['abs_tolerance'] = rule_columns[0].number_input(
+                                    "Abs tolerance", min_value=0.0, value=float(rule['abs_tolerance']),
+                                    format="%g", key=f"abs_tol_{query1['name']}_{column}")
+                                rule['rel_tolerance'] = rule_columns[1].number_input(
+                                    "Rel tolerance", min_value=0.0, value=float(rule['rel_tolerance']),
+                                    format="%g", key=f"rel_tol_{query1['name']}_{column}")
+                                rule['time_tolerance_seconds'] = rule_columns[2].number_input(
+                                    "Time tolerance (s)", min_value=0.0, value=float(rule['time_tolerance_seconds']),
+                                    key=f"time_tol_{query1['name']}_{column}")
+                                rule['ignore_case'] = rule_columns[3].checkbox(
+                                    "Ignore case", value=rule['ignore_case'],
+                                    key=f"ignore_case_{query1['name']}_{column}")
+                                rule['trim_whitespace'] = rule_columns[4].checkbox(
+                                    "Trim whitespace", value=rule['trim_whitespace'],
+                                    key=f"trim_{query1['name']}_{column}")
+                                rule['null_equals_null'] = rule_columns[5].checkbox(
+                                    "NULL = NULL", value=rule['null_equals_null'],
+                                    key=f"null_eq_{query1['name']}_{column}")
+                                # Only settings that differ from the defaults are stored
+                                compare_rules[column] = {name: value for name, value in rule.items()
+                                                         if value != DEFAULT_COMPARE_RULE[name]}
+                                if not compare_rules[column]:
+                                    del compare_rules[column]
+                        if comparison_mode == COMPARE_PUSHDOWN and any(column in compare_rules
+                                                                       for column in selected_columns_1):
+                            st.warning("Comparison rules are not applied by the warehouse pushdown comparison.")
+
+                    precheck_profiles = st.checkbox("Pre-check column profiles in the warehouse", value=True)
 
                     if st.button("Initiate Comparison"):
-                        try:
-                            df1_common, df2_common = compare_dataframes(df1, df2, selected_column_1, selected_column_2,
-                                                                        use_primary=use_primary_key)
-
-                            # Display Tables and Comparison Results
-                            st.subheader("Data Table 1")
-                            st.dataframe(df1)  # Displays with index as row number
-
-                            st.subheader("Data Table 2")
-                            st.dataframe(df2)  # Displays with index as row number
-
-                            if not df1_common.empty:
-                                st.subheader("Comparison Results")
-                                diff_df = pd.DataFrame({
-                                    #"Row": df1_common.index + 1,  # Adding +1 to make it 1-based indexing in display
-                                    f"{query1['name']} ({selected_column_1})": df1_common,
-                                    f"{query2['name']} ({selected_column_2})": df2_common,
-                                }).reset_index(drop=True)
-                                st.write(diff_df)
-                            else:
-                                st.subheader("Comparison Results")
-                                st.write("No differences found in the selected columns.")
-                        except Exception as e:
-                            st.error(f"Comparison failed: {e}")
+                        if not selected_columns_1 or len(selected_columns_1) != len(selected_columns_2):
+                            st.warning("Select the same number of columns (at least one) from each query.")
+                        elif use_primary_key and (not primary_keys_1 or len(primary_keys_1) != len(primary_keys_2)):
+                            st.warning("Select the same number of primary key columns (at least one) "
+                                       "from each query.")
+                        else:
+                            try:
+                                # Pre-check: only columns whose warehouse profiles differ are compared row by row
+                                identical = False
+                                if precheck_profiles:
+                                    identical, pairs, mismatches = profile_precheck(
+                                        query1, get_query_connection(query1, st.session_state["connections"]),
+                                        query2, get_query_connection(query2, st.session_state["connections"]),
+                                        primary_keys_1, primary_keys_2, selected_columns_1, selected_columns_2,
+                                        schema_1.loc[schema_1['numeric'], 'column'].tolist(),
+                                        schema_2.loc[schema_2['numeric'], 'column'].tolist(), rules=compare_rules)
+                                    if not identical:
+                                        if len(mismatches):
+                                            st.write("Column profiles that differ:", mismatches)
+                                        skipped = [column for column in selected_columns_1
+                                                   if column not in {column_1 for column_1, _ in pairs}]
+                                        if skipped:
+                                            st.info("Not compared row by row, their profiles and key-paired "
+                                                    f"checksums match: {', '.join(skipped)}")
+                                        selected_columns_1 = [column_1 for column_1, _ in pairs]
+                                        selected_columns_2 = [column_2 for _, column_2 in pairs]
+
+                                # The full fetch only happens now, and only if the rows are compared locally
+                                df1, df2 = None, None
+                                fetch_columns_1 = primary_keys_1 + selected_columns_1
+                                fetch_columns_2 = primary_keys_2 + selected_columns_2
+                                if in_memory and not identical:
+                                    df1 = run_query(query1, st.session_state["connections"], full_fetch=True,
+                                                    fetch_mode='arrow', columns=fetch_columns_1)
+                                    df2 = run_query(query2, st.session_state["connections"], full_fetch=True,
+                                                    fetch_mode='arrow', columns=fetch_columns_2)
+                                    if df1 is None or df2 is None:
+                                        raise ValueError("Could not fetch one or both datasets for comparison.")
+                                    # Reset index to ensure it starts from 0, providing a row index
+                                    df1.reset_index(drop=True, inplace=True)
+                                    df2.reset_index(drop=True, inplace=True)
+
+                                # Pre-flight: duplicate keys decide how rows are paired
+                                has_duplicates = False
+                                if use_primary_key and not identical:
+                                    for query, df, keys in ((query1, df1, primary_keys_1),
+                                                            (query2, df2, primary_keys_2)):
+                                        if in_memory:
+                                            duplicates = find_duplicate_keys(df, keys)
+                                        else:
+                                            duplicates = find_duplicate_keys_sql(
+                                                query, get_query_connection(query, st.session_state["connections"]),
+                                                keys)
+                                        has_duplicates = render_duplicate_keys(duplicates, query['name']) \
+                                            or has_duplicates
+
+                                if identical:
+                                    st.success("Column profiles and row checksums match, no differences found.")
+                                elif comparison_mode == COMPARE_PUSHDOWN:
+                                    conn_config = get_query_connection(query1, st.session_state["connections"])
+                                    result = pushdown_diff(query1, query2, conn_config, primary_keys_1,
+                                                           primary_keys_2, selected_columns_1, selected_columns_2,
+                                                           occurrence=has_duplicates)
+                                    render_diff_result(result, query1['name'], query2['name'])
+                                elif comparison_mode == COMPARE_CHECKSUM:
+                                    if len(primary_keys_1) != 1:
+                                        raise ValueError("Checksum comparison needs a single integer primary key.")
+                                    result = checksum_diff(
+                                        query1, get_query_connection(query1, st.session_state["connections"]),
+                                        query2, get_query_connection(query2, st.session_state["connections"]),
+                                        primary_keys_1[0], primary_keys_2[0], selected_columns_1,
+                                        selected_columns_2, rules=compare_rules)
+                                    render_diff_result(result, query1['name'], query2['name'])
+                                    st.caption(f"Fetched {result['summary']['fetched_rows']} rows using "
+                                               f"{result['summary']['checksum_queries']} checksum queries.")
+                                elif comparison_mode == COMPARE_SEMI_JOIN:
+                                    if not use_primary_key:
+                                        raise ValueError("Semi-join comparison needs a primary key.")
+                                    result = semi_join_diff(
+                                        query1, get_query_connection(query1, st.session_state["connections"]),
+                                        query2, get_query_connection(query2, st.session_state["connections"]),
+                                        primary_keys_1, primary_keys_2, selected_columns_1, selected_columns_2,
+                                        method=semi_join_method, rules=compare_rules)
+                                    render_diff_result(result, query1['name'], query2['name'])
+                                    st.caption(f"Fetched {result['summary']['fetched_rows']} rows, keys shipped via "
+                                               f"{result['summary']['semi_join_method']}.")
+                                elif comparison_mode == COMPARE_OUT_OF_CORE:
+                                    if not use_primary_key:
+                                        raise ValueError("Out-of-core comparison needs a primary key.")
+                                    expected_rows, _ = fetch_batch_counts([query1, query2],
+                                                                          st.session_state["connections"])
+                                    result = out_of_core_diff(
+                                        run_query_stream(query1, st.session_state["connections"],
+                                                         columns=fetch_columns_1),
+                                        run_query_stream(query2, st.session_state["connections"],
+                                                         columns=fetch_columns_2),
+                                        primary_keys_1, primary_keys_2, selected_columns_1, selected_columns_2,
+                                        expected_rows=[rows or 0 for rows in expected_rows],
+                                        memory_budget=memory_budget_mb * 2 ** 20, workers=spill_workers,
+                                        rules=compare_rules)
+                                    render_diff_result(result, query1['name'], query2['name'])
+                                    st.caption(f"Compared in {result['summary']['partitions']} partitions.")
+                                else:
+                                    # Display Tables and Comparison Results
+                                    st.subheader("Data Table 1")
+                                    st.dataframe(df1)  # Displays with index as row number
+
+                                    st.subheader("Data Table 2")
+                                    st.dataframe(df2)  # Displays with index as row number
+
+                                    if use_primary_key:
+                                        result = parallel_hash_diff(df1, df2, primary_keys_1, primary_keys_2,
+                                                                    selected_columns_1, selected_columns_2,
+                                                                    workers=compare_workers, rules=compare_rules)
+                                        render_diff_result(result, query1['name'], query2['name'])
+                                    elif ordered_rows:
+                                        result = ordered_diff(df1, df2, selected_columns_1, selected_columns_2,
+                                                              rules=compare_rules)
+                                        render_diff_result(result, query1['name'], query2['name'])
+                                        if len(result['edit_script']):
+                                            st.write("Edit script:")
+                                            st.write(result['edit_script'])
+                                    else:
+                                        result = multiset_diff(df1, df2, selected_columns_1, selected_columns_2,
+                                                               rules=compare_rules)
+                                        render_diff_result(result, query1['name'], query2['name'])
+                            except Exception as e:
+                                st.error(f"Comparison failed: {e}")
                 else:
-                    st.warning("Could not fetch one or both datasets for comparison.")
+                    st.warning("Could not read the columns of one or both queries.")
         else:
             st.info("Please select exactly two queries to proceed with a comparison.")
 
 
 
 def compare_columns(df1, df2):
+    # Only the proposed column pairs are compared, not every column against every other
     comparisons = []
-    for col1 in df1.columns:
-        for col2 in df2.columns:
-            comparison = df1[col1].compare(df2[col2], keep_shape=True, keep_equal=False)
-            if not comparison.empty:
-                comparisons.append((col1, col2, comparison))
+    for col1, col2 in match_columns(df1, df2)[['column_1', 'column_2']].itertuples(index=False):
+        comparison = df1[col1].compare(df2[col2], keep_shape=True, keep_equal=False)
+        if not comparison.empty:
+            comparisons.append((col1, col2, comparison))
     return comparisons
 
 